@@ -1,6 +1,9 @@
+import hashlib
+import json
 import logging
 import os
-from zipfile import ZipFile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from django.conf import settings
@@ -21,7 +24,9 @@ logger = logging.getLogger(__name__)
 
 
 class Zip:
-    tmp_folder = "/tmp"
+    tmp_folder = settings.BAG_DUMP_DIR
+    manifest_name = "bag_dumps.json"
+    chunk_size = 1024 * 1024
     model_to_endpoint = {
         Ligplaats: "bag_ligplaatsen.csv.zip",
         Openbareruimte: "bag_openbareruimtes.csv.zip",
@@ -32,41 +37,182 @@ class Zip:
         Verblijfsobjectpandrelatie: "benkagg_bagpandbevatverblijfsobjecten.csv.zip",
     }
 
-    @retry(tries=5)
+    def __init__(self):
+        # One session per thread, so the connection to the server is reused. Sessions are not
+        # safe to share between the threads that prefetch the dumps.
+        self._local = threading.local()
+        # The download of each prefetched endpoint
+        self._downloads = {}
+        self._executor = None
+        # The ETag, Last-Modified and sha256 of the dumps in tmp_folder that were imported,
+        # and of the dumps that were downloaded since
+        self._manifest = None
+        self.downloaded_versions = {}
+        self.unchanged_endpoints = set()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+            self._local.session.headers["User-Agent"] = "Mozilla/5.0"
+        return self._local.session
+
+    def prefetch(self, workers: int = settings.BAG_DOWNLOAD_WORKERS):
+        """
+        Start downloading all dumps in background threads, in the order of model_to_endpoint.
+        get_records waits for the download of its dump, so the first models can be imported
+        while the others are still downloading. Call shutdown when done.
+        """
+        # Load the manifest before the threads need it
+        self.manifest
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bag-download")
+        for endpoint in self.model_to_endpoint.values():
+            self._downloads[endpoint] = self._executor.submit(self.download_zip, endpoint)
+
+    def shutdown(self):
+        """Cancel the downloads that did not start yet and wait for the running ones."""
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def get_dump(self, endpoint: str):
+        """Return the path of a dump, waiting for its download when it was prefetched."""
+        if endpoint in self._downloads:
+            return self._downloads.pop(endpoint).result()
+        return self.download_zip(endpoint)
+
+    @property
+    def manifest_path(self):
+        return f"{self.tmp_folder}/{self.manifest_name}"
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = {}
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path) as f:
+                    self._manifest = json.load(f)
+        return self._manifest
+
+    def save_manifest(self):
+        """
+        Record the downloaded dumps as imported. Call this only when their import succeeded,
+        a dump that is in the manifest is skipped by the next import when it did not change.
+        """
+        manifest = {**self.manifest, **self.downloaded_versions}
+        with open(f"{self.manifest_path}.part", "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(f"{self.manifest_path}.part", self.manifest_path)
+        self._manifest = manifest
+        self.downloaded_versions = {}
+
+    def is_unchanged(self, bag_model):
+        return self.model_to_endpoint[bag_model] in self.unchanged_endpoints
+
     def download_zip(self, endpoint: str):
+        """
+        Download a dump to tmp_folder. When the dump that is there was imported before, the
+        request is conditional and the server only sends the dump when it changed since.
+        """
         api_endpoint = f"{settings.BAG_DUMP_BASE_URL}/{endpoint}"
         logger.info(f"Downloading from {api_endpoint}")
-        response = requests.get(
-            api_endpoint,
-            timeout=300,
-            headers={"User-Agent": "Mozilla/5.0"},
-        )
-        response.raise_for_status()
         path = f"{self.tmp_folder}/{endpoint}"
-        if os.path.exists(path):
-            os.remove(path)
-            logger.info(f"Existing zip {path} was removed")
-        with open(path, "wb") as f:
-            f.write(response.content)
+        part_path = f"{path}.part"
+        # A part that was left behind by an earlier run can be of another version of the dump
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+        cached_version = self.manifest.get(endpoint)
+        if cached_version and not (os.path.exists(path) and _get_sha256(path) == cached_version["sha256"]):
+            logger.info(f"Cached dump {path} is missing or changed, it is downloaded again")
+            cached_version = None
+
+        version = self._download_to_file(api_endpoint, part_path, {}, cached_version)
+        if version is None:
+            logger.info(f"{api_endpoint} is not modified since the previous import")
+            self.unchanged_endpoints.add(endpoint)
+            return path
+
+        os.replace(part_path, path)
+        self.downloaded_versions[endpoint] = {**version, "sha256": _get_sha256(path)}
+        logger.info(f"Downloaded {api_endpoint} to {path}")
+        # A server that ignores the conditional headers sends the same dump again
+        imported_version = self.manifest.get(endpoint)
+        if imported_version and imported_version["sha256"] == self.downloaded_versions[endpoint]["sha256"]:
+            logger.info(f"{api_endpoint} has the same content as the previous import")
+            self.unchanged_endpoints.add(endpoint)
         return path
 
-    def unpack_zip(self, path_source: str):
-        remove_file_ext = lambda x: x.rsplit(".", 1)[0]
-        path_target = remove_file_ext(path_source)
-        with ZipFile(path_source, "r") as zip:
-            zip.extractall(
-                path=os.path.dirname(path_target),
-                members=[os.path.basename(path_target)],
-            )
-            logger.info(f"Zip {path_source} unpacked")
-        return path_target
+    @retry(tries=5)
+    def _download_to_file(self, url: str, path: str, version: dict, cached_version: dict = None):
+        """
+        Stream url to path in chunks and return the ETag and Last-Modified of the download,
+        or None when the server reports that cached_version is still the current one.
+        When a retry finds the start of the file in path, only the rest is requested with a
+        Range header. The version of the first response goes along in If-Range, so a server
+        with a changed file sends all of it.
+        """
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        headers = {}
+        if offset and _get_range_validator(version):
+            headers = {"Range": f"bytes={offset}-", "If-Range": _get_range_validator(version)}
+        elif cached_version:
+            if cached_version.get("etag"):
+                headers["If-None-Match"] = cached_version["etag"]
+            if cached_version.get("last_modified"):
+                headers["If-Modified-Since"] = cached_version["last_modified"]
+
+        with self.session.get(url, headers=headers, stream=True, timeout=300) as response:
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+            if response.status_code == 206:
+                # A part that does not continue where the file stopped would corrupt the dump
+                if _get_range_start(response.headers.get("Content-Range")) != offset:
+                    os.remove(path)
+                    version.clear()
+                    raise Exception(
+                        f"Got Content-Range {response.headers.get('Content-Range')} for {url} while asking for "
+                        f"bytes from {offset}, the download is started again"
+                    )
+                logger.info(f"Resuming the download of {url} at {offset} bytes")
+                mode = "ab"
+            else:
+                version.clear()
+                version.update(etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
+                mode = "wb"
+
+            with open(path, mode) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+        return version
 
     def get_records(self, bag_model):
         assert self.model_to_endpoint and bag_model in self.model_to_endpoint, "No model_to_endpoints have been defined"
 
         return pipe(
             self.model_to_endpoint.get(bag_model),
-            self.download_zip,
-            self.unpack_zip,
+            self.get_dump,
             partial(read_csv, field_mapping=bag_model.get_column_field_mapping()),
         )
+
+
+def _get_range_validator(version: dict):
+    # Weak ETags can not be used for ranges
+    etag = version.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return version.get("last_modified")
+
+
+def _get_range_start(content_range: str):
+    # Content-Range looks like "bytes 1000-1999/2000"
+    try:
+        return int(content_range.removeprefix("bytes ").split("-")[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+def _get_sha256(path: str):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
@@ -1,6 +1,11 @@
+import io
+import itertools
 import logging
 from datetime import datetime
 
+from django.conf import settings
+from django.contrib.gis.db.models import GeometryField
+from django.db import connection, transaction
 from isodate import parse_date, parse_datetime
 from toolz import interleave, partial, pipe
 
@@ -11,11 +16,33 @@ from bag.models import (
     Verblijfsobjectpandrelatie,
 )
 from bag.utils import chunk_data
+from importer.util_db import copy_value
 
 logger = logging.getLogger(__name__)
 
+# Materialized views with the flattened BAG addresses, in the order they have to be refreshed
+ADRES_LOOKUP_VIEWS = ["bag_adres_lookup", "bag_adres_pand_lookup"]
+
+BAG_WRITERS = ["orm", "copy"]
+
+# Number of records that are sent to the staging table in one COPY
+COPY_CHUNK_SIZE = 100000
+
+# TEMPORARY: Remove when api returns object for specified api urls
+INVALID_NUMMERAANDUIDING_VERBLIJFSOBJECTEN = {
+    # https://api.data.amsterdam.nl/v1/bag/verblijfsobjecten/0363010012582763
+    # or https://api.data.amsterdam.nl/v1/bag/nummeraanduidingen/?adresseertVerblijfsobject.identificatie=0363010012582763
+    "0363010012582763",
+    # https://api.data.amsterdam.nl/v1/bag/verblijfsobjecten/0363010011290888
+    # or https://api.data.amsterdam.nl/v1/bag/nummeraanduidingen/?adresseertVerblijfsobject.identificatie=0363010011290888
+    "0363010011290888",
+}
+
 
 class BagController:
+    def __init__(self, writer=settings.BAG_WRITER):
+        self.writer = writer
+
     def create_bag_instances(self, bag_model, row: dict):
         bag_dict = {}
         for field, value in row.items():
@@ -40,15 +67,15 @@ class BagController:
             raise e
 
     def is_valid_object(self, obj):
-        # TEMPORARY: Remove when api returns object for specified api urls
         return not (
-            # https://api.data.amsterdam.nl/v1/bag/verblijfsobjecten/0363010012582763
-            # or https://api.data.amsterdam.nl/v1/bag/nummeraanduidingen/?adresseertVerblijfsobject.identificatie=0363010012582763
-            isinstance(obj, Nummeraanduiding) and obj.verblijfsobject_id == "0363010012582763"
-        ) and not (
-            # https://api.data.amsterdam.nl/v1/bag/verblijfsobjecten/0363010011290888
-            # or https://api.data.amsterdam.nl/v1/bag/nummeraanduidingen/?adresseertVerblijfsobject.identificatie=0363010011290888
-            isinstance(obj, Nummeraanduiding) and obj.verblijfsobject_id == "0363010011290888"
+            isinstance(obj, Nummeraanduiding) and obj.verblijfsobject_id in INVALID_NUMMERAANDUIDING_VERBLIJFSOBJECTEN
+        )
+
+    @staticmethod
+    def is_valid_record(bag_model, record: dict):
+        return not (
+            bag_model is Nummeraanduiding
+            and record.get("verblijfsobject") in INVALID_NUMMERAANDUIDING_VERBLIJFSOBJECTEN
         )
 
     def upsert_table_data(self, bag_objects: iter):
@@ -77,6 +104,8 @@ class BagController:
 
     def upsert_records_in_database(self, bag_model, records):
         logger.info(f"Upserting records in {bag_model}")
+        if self.writer == "copy":
+            return self.copy_records_in_database(bag_model, records)
 
         return pipe(
             records,
@@ -87,6 +116,75 @@ class BagController:
             interleave,
         )
 
+    def copy_records_in_database(self, bag_model, records):
+        """
+        Upsert csv records without creating model instances. The records are copied as text
+        into a temporary staging table, from which a single INSERT casts them to the column
+        types of the table. Only the columns that are in the records are staged and written.
+        Returns the primary keys of all the records.
+
+        Rows are matched on their primary key, and rows that did not change are left alone, so
+        they are not rewritten and do not generate WAL. Records without a primary key, like the
+        Verblijfsobjectpandrelatie records, are matched on all their columns instead: the
+        matching rows are kept and the others are inserted with a primary key from the sequence.
+        """
+        valid_records = (record for record in records if self.is_valid_record(bag_model, record))
+        first_record = next(valid_records, None)
+        if first_record is None:
+            logger.warning("- copy_records_in_database with empty records argument")
+            return []
+
+        pk_field = bag_model._meta.pk
+        fields = [
+            field
+            for field in bag_model._meta.concrete_fields
+            if field.name in first_record and (not field.primary_key or first_record[field.name])
+        ]
+        table = bag_model._meta.db_table
+        staging_table = f"{table}_staging"
+        qn = connection.ops.quote_name
+        columns = [qn(field.column) for field in fields]
+        update_columns = [qn(field.column) for field in fields if not field.primary_key]
+
+        # The staging table only lives until the end of the transaction
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE {staging_table} ({', '.join(f'{column} text' for column in columns)}) "
+                "ON COMMIT DROP"
+            )
+
+            for chunk in chunk_data(itertools.chain([first_record], valid_records), chunk_size=COPY_CHUNK_SIZE):
+                buffer = io.StringIO()
+                for record in chunk:
+                    buffer.write("\t".join(copy_value(record.get(field.name)) for field in fields) + "\n")
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+            staged = f"SELECT {', '.join(f'{_cast_column(field)} AS {qn(field.column)}' for field in fields)} FROM {staging_table}"
+            if pk_field in fields:
+                cursor.execute(
+                    f"INSERT INTO {table} ({', '.join(columns)}) {staged} "
+                    f"ON CONFLICT ({qn(pk_field.column)}) DO UPDATE SET "
+                    f"{', '.join(f'{column} = EXCLUDED.{column}' for column in update_columns)} "
+                    f"WHERE ({', '.join(f'{table}.{column}' for column in update_columns)}) "
+                    f"IS DISTINCT FROM ({', '.join(f'EXCLUDED.{column}' for column in update_columns)})"
+                )
+                logger.info(f"Inserted or updated {cursor.rowcount} records in {bag_model}")
+                cursor.execute(f"SELECT {_cast_column(pk_field)} FROM {staging_table}")
+            else:
+                # Columns with a NULL never match, those rows are inserted again and the old ones
+                # are deleted afterwards as they are not in the returned keys
+                matches = " AND ".join(f"{table}.{column} = staged.{column}" for column in columns)
+                cursor.execute(
+                    f"WITH staged AS ({staged}), "
+                    f"inserted AS (INSERT INTO {table} ({', '.join(columns)}) SELECT * FROM staged "
+                    f"WHERE NOT EXISTS (SELECT FROM {table} WHERE {matches}) RETURNING {qn(pk_field.column)}) "
+                    f"SELECT {qn(pk_field.column)} FROM inserted "
+                    f"UNION ALL SELECT {qn(pk_field.column)} FROM {table} WHERE EXISTS (SELECT FROM staged WHERE {matches})"
+                )
+            return [pk for (pk,) in cursor.fetchall()]
+
     @staticmethod
     def filter_valid_references(bag_model, records, *, threshold=5):
         if bag_model != Verblijfsobjectpandrelatie:
@@ -122,3 +220,22 @@ class BagController:
         logger.info(f"Deleting records from {bag_model}")
         num_deleted, _ = bag_model.objects.exclude(pk__in=upserted_pk_indices).delete()
         logger.info(f"Deleted {num_deleted} records from {bag_model}")
+
+    @staticmethod
+    def refresh_adres_lookup():
+        logger.info("Refreshing the BAG adres lookup views")
+        with connection.cursor() as cursor:
+            for view in ADRES_LOOKUP_VIEWS:
+                cursor.execute(f"REFRESH MATERIALIZED VIEW {view}")
+        logger.info("Refreshed the BAG adres lookup views")
+
+
+def _cast_column(field):
+    """SQL expression that casts a text column of the staging table to the type of field."""
+    column = connection.ops.quote_name(field.column)
+    if field.null:
+        column = f"NULLIF({column}, '')"
+    if isinstance(field, GeometryField):
+        # The dumps have the geometries as WKT without a srid
+        return f"ST_SetSRID({column}::geometry, {field.srid})"
+    return f"CAST({column} AS {field.rel_db_type(connection) if field.is_relation else field.db_type(connection)})"
@@ -0,0 +1,55 @@
+# Generated by Django 6.0.2 on 2026-10-18 10:04
+
+from django.db import migrations
+
+# Flattened BAG addresses, used to match the adressen of the dossiers with the BAG.
+# The views are refreshed at the end of every BAG import.
+CREATE_ADRES_LOOKUP = """
+CREATE MATERIALIZED VIEW bag_adres_lookup AS
+SELECT
+    bnumm.identificatie AS nummeraanduiding_id,
+    bnumm.adresseertverblijfsobjectid AS verblijfsobject_id,
+    bopen.identificatie AS openbareruimte_id,
+    bopen.naam AS straat,
+    bnumm.huisnummer,
+    bopen.naam || ' ' || bnumm.huisnummer ||
+        CASE WHEN (bnumm.huisletter = '') IS NOT FALSE THEN '' ELSE bnumm.huisletter END ||
+        CASE WHEN (bnumm.huisnummertoevoeging = '') IS NOT FALSE THEN '' ELSE '-' || bnumm.huisnummertoevoeging
+        END AS label
+FROM bag_nummeraanduiding bnumm
+JOIN bag_openbareruimte bopen ON bopen.identificatie = bnumm.ligtaanopenbareruimteid;
+
+CREATE INDEX bag_adres_lookup_verblijfsobject_idx ON bag_adres_lookup (verblijfsobject_id);
+CREATE INDEX bag_adres_lookup_straat_huisnummer_idx ON bag_adres_lookup (straat, huisnummer);
+
+CREATE MATERIALIZED VIEW bag_adres_pand_lookup AS
+SELECT
+    lookup.nummeraanduiding_id,
+    lookup.verblijfsobject_id,
+    bpand.identificatie AS pand_id,
+    bpand.ligtinbouwblokid AS bouwblok,
+    lookup.straat,
+    lookup.huisnummer,
+    lookup.label
+FROM bag_adres_lookup lookup
+JOIN bag_verblijfsobject bverb ON bverb.identificatie = lookup.verblijfsobject_id
+JOIN bag_verblijfsobjectpandrelatie bvpr ON bvpr.verblijfsobjectenidentificatie = bverb.identificatie
+JOIN bag_pand bpand ON bpand.identificatie = bvpr.ligtinpandenidentificatie;
+
+CREATE INDEX bag_adres_pand_lookup_straat_huisnummer_idx ON bag_adres_pand_lookup (straat, huisnummer);
+"""
+
+DROP_ADRES_LOOKUP = """
+DROP MATERIALIZED VIEW bag_adres_pand_lookup;
+DROP MATERIALIZED VIEW bag_adres_lookup;
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bag", "0007_alter_bagupdatedat_id"),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_ADRES_LOOKUP, DROP_ADRES_LOOKUP),
+    ]
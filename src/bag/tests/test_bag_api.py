@@ -1,4 +1,6 @@
+import threading
 from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
 
 import pytest
@@ -7,7 +9,73 @@ from model_bakery import baker
 from bag.bag_api import Zip
 from bag.models import Ligplaats, Pand
 
-from .utils import MockResponse
+DUMP_CONTENT = bytes(range(256)) * 4096
+DUMP_ETAG = '"dump-1"'
+
+
+class DumpRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves DUMP_CONTENT with support for Range and conditional requests. The first response
+    is cut off halfway.
+    """
+
+    received_headers = []
+
+    def do_GET(self):
+        self.received_headers.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == DUMP_ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get("Range") and self.headers.get("If-Range") == DUMP_ETAG:
+            start = int(self.headers["Range"].removeprefix("bytes=").removesuffix("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(DUMP_CONTENT) - 1}/{len(DUMP_CONTENT)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", DUMP_ETAG)
+        self.send_header("Content-Length", str(len(DUMP_CONTENT) - start))
+        self.end_headers()
+
+        body = DUMP_CONTENT[start:]
+        if len(self.received_headers) == 1:
+            body = body[: len(body) // 2]
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WrongRangeRequestHandler(DumpRequestHandler):
+    """Like DumpRequestHandler, but a range is always sent from the start of the dump."""
+
+    def send_header(self, keyword, value):
+        if keyword == "Content-Range":
+            value = f"bytes 0-{len(DUMP_CONTENT) - 1}/{len(DUMP_CONTENT)}"
+        super().send_header(keyword, value)
+
+
+def _serve_dumps(settings, handler_class):
+    handler_class.received_headers = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    settings.BAG_DUMP_BASE_URL = f"http://127.0.0.1:{server.server_port}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dump_server(settings):
+    yield from _serve_dumps(settings, DumpRequestHandler)
+
+
+@pytest.fixture
+def wrong_range_dump_server(settings):
+    yield from _serve_dumps(settings, WrongRangeRequestHandler)
 
 
 class TestBagZipApi:
@@ -17,17 +85,102 @@ class TestBagZipApi:
         with pytest.raises(AssertionError):
             bag_zip_api.get_records(Ligplaats)
 
-    @patch("bag.bag_api.requests.get")
-    def test_download_zip(self, mock_request):
-        mock_request.return_value = MockResponse({}, 200, content=b"b")
-        path = Zip().download_zip("mocked")
-        assert path == "/tmp/mocked"
+    @patch("bag.utils.time.sleep")
+    def test_download_zip(self, mock_sleep, dump_server, tmp_path):
+        bag_zip_api = Zip()
+        bag_zip_api.tmp_folder = str(tmp_path)
+        bag_zip_api.chunk_size = 1024
+        path = bag_zip_api.download_zip("mocked")
+
+        assert path == f"{tmp_path}/mocked"
+        with open(path, "rb") as f:
+            assert f.read() == DUMP_CONTENT
+        assert not (tmp_path / "mocked.part").exists()
+
+        # The download that was cut off is continued where it stopped
+        first_request, second_request = DumpRequestHandler.received_headers
+        assert "Range" not in first_request
+        assert second_request["Range"] == f"bytes={len(DUMP_CONTENT) // 2}-"
+        assert second_request["If-Range"] == DUMP_ETAG
+
+    @patch("bag.utils.time.sleep")
+    def test_download_zip_wrong_range(self, mock_sleep, wrong_range_dump_server, tmp_path):
+        bag_zip_api = Zip()
+        bag_zip_api.tmp_folder = str(tmp_path)
+        path = bag_zip_api.download_zip("mocked")
+
+        # The part that did not start at the requested offset is not appended, the dump is
+        # downloaded again from the start
+        with open(path, "rb") as f:
+            assert f.read() == DUMP_CONTENT
+        first_request, second_request, third_request = WrongRangeRequestHandler.received_headers
+        assert second_request["Range"] == f"bytes={len(DUMP_CONTENT) // 2}-"
+        assert "Range" not in third_request
+
+    @patch("bag.utils.time.sleep")
+    def test_download_zip_unchanged(self, mock_sleep, dump_server, tmp_path):
+        bag_zip_api = Zip()
+        bag_zip_api.tmp_folder = str(tmp_path)
+        bag_zip_api.model_to_endpoint = {Pand: "bag_panden.csv.zip"}
+        bag_zip_api.download_zip("bag_panden.csv.zip")
+        assert not bag_zip_api.is_unchanged(Pand)
+        bag_zip_api.save_manifest()
+
+        # The next import asks for the dump conditionally and keeps the cached one
+        bag_zip_api = Zip()
+        bag_zip_api.tmp_folder = str(tmp_path)
+        bag_zip_api.model_to_endpoint = {Pand: "bag_panden.csv.zip"}
+        path = bag_zip_api.download_zip("bag_panden.csv.zip")
+        assert bag_zip_api.is_unchanged(Pand)
+        assert DumpRequestHandler.received_headers[-1]["If-None-Match"] == DUMP_ETAG
+        with open(path, "rb") as f:
+            assert f.read() == DUMP_CONTENT
+
+        # A cached dump that does not match its checksum is downloaded again, its content is
+        # the same as the imported one so it is still unchanged
+        with open(path, "wb") as f:
+            f.write(b"broken")
+        bag_zip_api = Zip()
+        bag_zip_api.tmp_folder = str(tmp_path)
+        bag_zip_api.model_to_endpoint = {Pand: "bag_panden.csv.zip"}
+        bag_zip_api.download_zip("bag_panden.csv.zip")
+        assert bag_zip_api.is_unchanged(Pand)
+        assert "If-None-Match" not in DumpRequestHandler.received_headers[-1]
+        with open(path, "rb") as f:
+            assert f.read() == DUMP_CONTENT
+
+        # A dump with other content than the imported one is changed
+        bag_zip_api.manifest["bag_panden.csv.zip"]["sha256"] = "0" * 64
+        bag_zip_api.unchanged_endpoints = set()
+        bag_zip_api.download_zip("bag_panden.csv.zip")
+        assert not bag_zip_api.is_unchanged(Pand)
+
+    @patch("bag.utils.time.sleep")
+    def test_prefetch(self, mock_sleep, dump_server, tmp_path):
+        bag_zip_api = Zip()
+        bag_zip_api.tmp_folder = str(tmp_path)
+        bag_zip_api.model_to_endpoint = {
+            Ligplaats: "bag_ligplaatsen.csv.zip",
+            Pand: "bag_panden.csv.zip",
+        }
+        bag_zip_api.prefetch(workers=2)
+        try:
+            paths = [bag_zip_api.get_dump(endpoint) for endpoint in bag_zip_api.model_to_endpoint.values()]
+        finally:
+            bag_zip_api.shutdown()
+
+        assert paths == [f"{tmp_path}/bag_ligplaatsen.csv.zip", f"{tmp_path}/bag_panden.csv.zip"]
+        for path in paths:
+            with open(path, "rb") as f:
+                assert f.read() == DUMP_CONTENT
+        assert set(bag_zip_api.downloaded_versions) == {"bag_ligplaatsen.csv.zip", "bag_panden.csv.zip"}
+        # Every dump is downloaded only once, plus the retry of the one that was cut off
+        assert len(DumpRequestHandler.received_headers) == 3
 
     @pytest.mark.django_db
     @patch("bag.bag_api.Zip.download_zip")
-    @patch("bag.bag_api.Zip.unpack_zip")
     @patch("bag.bag_api.read_csv")
-    def test_get_bag_records(self, mock_read_csv, mock_unpack, mock_download):
+    def test_get_bag_records(self, mock_read_csv, mock_download):
         api = Zip()
         api.model_to_endpoint = {
             Ligplaats: "gebieden_ligplaatsen.csv.zip",
@@ -37,10 +190,6 @@ class TestBagZipApi:
             "/tmp/gebieden_ligplaatsen.csv.zip",
             "/tmp/bag_panden.csv.zip",
         ]
-        mock_unpack.side_effect = [
-            "/tmp/gebieden_ligplaatsen.csv",
-            "/tmp/bag_panden.csv",
-        ]
         mock_read_csv.side_effect = [
             [
                 x
@@ -1,8 +1,16 @@
 import pytest
+from django.db import connection
 from model_bakery import baker
 
 from bag.bag_controller import BagController
-from bag.models import Ligplaats, Pand, Verblijfsobject, Verblijfsobjectpandrelatie
+from bag.models import (
+    Ligplaats,
+    Nummeraanduiding,
+    Openbareruimte,
+    Pand,
+    Verblijfsobject,
+    Verblijfsobjectpandrelatie,
+)
 
 
 class TestBagController:
@@ -91,6 +99,101 @@ class TestBagController:
 
         assert Ligplaats.objects.count() == 2
 
+    @pytest.mark.django_db
+    def test_copy_records_in_database(self):
+        def pand_record(id, status, bouwlagen=""):
+            return {
+                "id": id,
+                "begin_geldigheid": "2023-07-22",
+                "einde_geldigheid": "",
+                "geometrie": "POLYGON ((0 0, 0 1, 1 1, 1 0, 0 0))",
+                "bouwlagen": bouwlagen,
+                "status": status,
+                "volgnummer": "1",
+                "registratiedatum": "2023-07-22T10:00:00",
+                "geconstateerd": "false",
+                "statuscode": "7",
+            }
+
+        bag = BagController(writer="copy")
+        upserted_keys = bag.upsert_records_in_database(
+            Pand,
+            [pand_record("0363100000000001", "Pand in gebruik"), pand_record("0363100000000002", "Bouw gestart", "3")],
+        )
+        assert sorted(upserted_keys) == ["0363100000000001", "0363100000000002"]
+
+        pand = Pand.objects.get(id="0363100000000002")
+        assert pand.bouwlagen == 3
+        assert pand.einde_geldigheid is None
+        assert pand.geconstateerd is False
+        assert pand.geometrie.srid == 28992
+
+        def get_row_versions():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT identificatie, ctid::text FROM bag_pand ORDER BY identificatie")
+                return dict(cursor.fetchall())
+
+        row_versions = get_row_versions()
+        upserted_keys = bag.upsert_records_in_database(
+            Pand,
+            [
+                pand_record("0363100000000001", "Pand in gebruik"),
+                pand_record("0363100000000002", "Pand in gebruik", "3"),
+            ],
+        )
+        assert sorted(upserted_keys) == ["0363100000000001", "0363100000000002"]
+        assert Pand.objects.get(id="0363100000000002").status == "Pand in gebruik"
+        # Only the changed pand is written again
+        new_row_versions = get_row_versions()
+        assert new_row_versions["0363100000000001"] == row_versions["0363100000000001"]
+        assert new_row_versions["0363100000000002"] != row_versions["0363100000000002"]
+
+    @pytest.mark.django_db
+    def test_copy_records_in_database_without_pk(self):
+        verblijfsobject = baker.make(Verblijfsobject, id="vot_1")
+        baker.make(Pand, id="pand_1")
+        baker.make(Pand, id="pand_2")
+        existing = baker.make(Verblijfsobjectpandrelatie, verblijfsobject=verblijfsobject, pand_id="pand_2")
+        bag = BagController(writer="copy")
+
+        records = [{"pand": "pand_1", "verblijfsobject": "vot_1"}]
+        upserted_keys = bag.upsert_records_in_database(Verblijfsobjectpandrelatie, records)
+        relatie = Verblijfsobjectpandrelatie.objects.get(pand_id="pand_1")
+        assert upserted_keys == [relatie.id]
+
+        # The existing rows are matched on their columns and keep their ids
+        records = [{"pand": "pand_1", "verblijfsobject": "vot_1"}, {"pand": "pand_2", "verblijfsobject": "vot_1"}]
+        upserted_keys = bag.upsert_records_in_database(Verblijfsobjectpandrelatie, records)
+        assert sorted(upserted_keys) == sorted([relatie.id, existing.id])
+        assert Verblijfsobjectpandrelatie.objects.count() == 2
+
+    @pytest.mark.django_db
+    def test_copy_records_in_database_keeps_missing_columns(self):
+        baker.make(Pand, id="0363100000000001", pandnaam="Rijksmuseum", status="Pand in gebruik")
+
+        records = [{"id": "0363100000000001", "status": "Pand gesloopt"}]
+        BagController(writer="copy").upsert_records_in_database(Pand, records)
+
+        pand = Pand.objects.get(id="0363100000000001")
+        assert pand.status == "Pand gesloopt"
+        assert pand.pandnaam == "Rijksmuseum"
+
+    @pytest.mark.django_db
+    def test_copy_records_in_database_skips_invalid_records(self):
+        verblijfsobject = baker.make(Verblijfsobject, id="0363010012582763")
+        records = [
+            {
+                "id": "0363200000000001",
+                "begin_geldigheid": "2010-11-17 00:00:00.000 +0100",
+                "huisnummer": "10",
+                "verblijfsobject": verblijfsobject.id,
+            }
+        ]
+        upserted_keys = BagController(writer="copy").upsert_records_in_database(Nummeraanduiding, records)
+
+        assert upserted_keys == []
+        assert Nummeraanduiding.objects.count() == 0
+
     @pytest.mark.django_db
     def test_filter_valid_references_passes(self):
         baker.make(Verblijfsobject, id="vot_1")
@@ -131,3 +234,31 @@ class TestBagController:
         records = [{"pand": "pand_1", "verblijfsobject": "vot_1"}]
         with pytest.raises(Exception):
             BagController().filter_valid_references(Verblijfsobjectpandrelatie, records, threshold=0)
+
+    @pytest.mark.django_db
+    def test_refresh_adres_lookup(self):
+        openbareruimte = baker.make(Openbareruimte, id="0363300000003592", naam="Hoogte Kadijk")
+        verblijfsobject = baker.make(Verblijfsobject, id="0363010000000001")
+        pand = baker.make(Pand, id="0363100000000001", bouwblok="03630012099080")
+        baker.make(Verblijfsobjectpandrelatie, verblijfsobject=verblijfsobject, pand=pand)
+        baker.make(
+            Nummeraanduiding,
+            id="0363200000000001",
+            openbare_ruimte=openbareruimte,
+            verblijfsobject=verblijfsobject,
+            huisnummer=40,
+            huisletter="A",
+            huisnummer_toevoeging="2",
+        )
+
+        BagController.refresh_adres_lookup()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nummeraanduiding_id, verblijfsobject_id, straat, huisnummer, label FROM bag_adres_lookup"
+            )
+            assert cursor.fetchall() == [
+                ("0363200000000001", "0363010000000001", "Hoogte Kadijk", 40, "Hoogte Kadijk 40A-2")
+            ]
+            cursor.execute("SELECT nummeraanduiding_id, pand_id, bouwblok FROM bag_adres_pand_lookup")
+            assert cursor.fetchall() == [("0363200000000001", "0363100000000001", "03630012099080")]
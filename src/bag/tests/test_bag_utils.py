@@ -1,6 +1,9 @@
 import csv
 import io
+import os
+import tempfile
 from unittest import mock
+from zipfile import ZipFile
 
 from django.test import TestCase, override_settings
 from model_bakery import baker
@@ -124,6 +127,18 @@ class UtilsTestCase(TestCase):
             assert rows[0]["identifier"] == "idval"
             assert rows[0]["column"] == "colval"
 
+    def test_read_csv_from_zip(self):
+        csv_data = mock_csv_from_dict({"identifier": "idval", "column": "colval, met komma"})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "bag_panden.csv.zip")
+            with ZipFile(path, "w") as zip_file:
+                zip_file.writestr("bag_panden.csv", csv_data)
+
+            rows = list(read_csv(path, field_mapping={"identifier": "id", "column": "col"}))
+            assert rows == [{"id": "idval", "col": "colval, met komma"}]
+            # Nothing is extracted
+            assert os.listdir(tmp_dir) == ["bag_panden.csv.zip"]
+
 
 def mock_csv_from_dict(obj):
     output = io.StringIO()
@@ -1,6 +1,9 @@
 import csv
+import io
 import logging
+import os
 import time
+from zipfile import ZipFile
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
@@ -116,12 +119,24 @@ def retry(tries=3, delay=1, backoff=2):
 
 
 def read_csv(path: str, *, field_mapping: dict = None):
-    with open(path, "r") as csv_file:
-        csv_reader = csv.DictReader(f=csv_file, delimiter=",")
-        if field_mapping:
-            csv_reader.fieldnames = [field_mapping.get(field.lower(), field.lower()) for field in csv_reader.fieldnames]
-        for row in csv_reader:
-            yield row
+    """
+    Yield the rows of a csv file as dicts. A zip is read without extracting it: the rows come
+    straight from the csv in it that has the name of the zip without .zip.
+    """
+    if path.endswith(".zip"):
+        with ZipFile(path) as zip_file, zip_file.open(os.path.basename(path).removesuffix(".zip")) as member:
+            yield from _read_csv_rows(io.TextIOWrapper(member, encoding="utf-8", newline=""), field_mapping)
+    else:
+        with open(path, "r") as csv_file:
+            yield from _read_csv_rows(csv_file, field_mapping)
+
+
+def _read_csv_rows(csv_file, field_mapping):
+    csv_reader = csv.DictReader(f=csv_file, delimiter=",")
+    if field_mapping:
+        csv_reader.fieldnames = [field_mapping.get(field.lower(), field.lower()) for field in csv_reader.fieldnames]
+    for row in csv_reader:
+        yield row
 
 
 def chunk_data(iterable, chunk_size=1000):
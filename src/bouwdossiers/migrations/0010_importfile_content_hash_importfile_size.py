@@ -0,0 +1,22 @@
+# Generated by Django 6.0.2 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bouwdossiers", "0009_alter_bouwdossier_options_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="importfile",
+            name="content_hash",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="importfile",
+            name="size",
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
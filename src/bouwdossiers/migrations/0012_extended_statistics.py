@@ -0,0 +1,28 @@
+# Generated by Django 6.0.2 on 2026-10-18 11:02
+
+from django.db import migrations
+
+# The columns of these statistics are correlated: a straat has a limited set of huisnummers
+# and wabo_bron is only filled for WABO dossiers. Without them the planner multiplies the
+# selectivities and underestimates the number of rows the dossier matching produces.
+CREATE_STATISTICS = """
+CREATE STATISTICS bouwdossiers_adres_straat_huisnummer_stat (ndistinct, dependencies)
+    ON straat, huisnummer_van, huisnummer_tot FROM bouwdossiers_adres;
+CREATE STATISTICS bouwdossiers_bouwdossier_source_stat (dependencies, mcv)
+    ON source, wabo_bron, stadsdeel FROM bouwdossiers_bouwdossier;
+"""
+
+DROP_STATISTICS = """
+DROP STATISTICS IF EXISTS bouwdossiers_adres_straat_huisnummer_stat;
+DROP STATISTICS IF EXISTS bouwdossiers_bouwdossier_source_stat;
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bouwdossiers", "0011_adres_huisnummers"),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_STATISTICS, DROP_STATISTICS),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.2 on 2026-10-18 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bouwdossiers", "0012_extended_statistics"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="importfile",
+            name="etag",
+            field=models.CharField(max_length=128, null=True),
+        ),
+    ]
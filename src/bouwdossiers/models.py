@@ -1,7 +1,8 @@
 from django.contrib.gis.db import models
-from django.contrib.postgres.fields import ArrayField
-from django.contrib.postgres.indexes import GinIndex
-from django.db.models import CASCADE
+from django.contrib.postgres.fields import ArrayField, IntegerRangeField
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.db.models import CASCADE, Case, F, Func, Value, When
+from django.db.models.functions import Coalesce
 
 import bouwdossiers.constants as const
 
@@ -30,6 +31,11 @@ class ImportFileBase(models.Model):
     name = models.CharField(max_length=512, null=False, unique=True)
     status = models.CharField(max_length=1, null=False, choices=IMPORT_CHOICES)
     last_import = models.DateTimeField(auto_now=True)
+    # sha256 and size of the imported file, used to skip unchanged files in an incremental import
+    content_hash = models.CharField(max_length=64, null=True)
+    size = models.BigIntegerField(null=True)
+    # ETag of the blob the file was read from, the blob source compares it instead of the sha256
+    etag = models.CharField(max_length=128, null=True)
 
     def __str__(self):
         return f"{self.name}"
@@ -104,6 +110,26 @@ class AdresBase(models.Model):
     straat = models.CharField(max_length=150, null=True)
     huisnummer_van = models.IntegerField(null=True)
     huisnummer_tot = models.IntegerField(null=True)
+    # The house numbers as a range, to find addresses by house number with an index. The range is
+    # empty when huisnummer_tot is below huisnummer_van and is only huisnummer_van without huisnummer_tot
+    huisnummers = models.GeneratedField(
+        expression=Case(
+            When(huisnummer_van__isnull=True, then=None),
+            When(
+                huisnummer_tot__lt=F("huisnummer_van"),
+                then=Func(Value(0), Value(0), function="int4range", output_field=IntegerRangeField()),
+            ),
+            default=Func(
+                F("huisnummer_van"),
+                Coalesce(F("huisnummer_tot"), F("huisnummer_van")),
+                Value("[]"),
+                function="int4range",
+                output_field=IntegerRangeField(),
+            ),
+        ),
+        output_field=IntegerRangeField(),
+        db_persist=True,
+    )
     openbareruimte_id = models.CharField(max_length=16, db_index=True, null=True)  # landelijk_id
     stadsdeel = models.CharField(max_length=10, db_index=True)
     nummeraanduidingen = ArrayField(models.CharField(max_length=16, null=False), blank=True)
@@ -121,7 +147,11 @@ class AdresBase(models.Model):
         return f"{self.straat} {self.huisnummer_van} - {self.huisnummer_tot}"
 
     class Meta:
-        indexes = [GinIndex(fields=["nummeraanduidingen"]), GinIndex(fields=["panden"])]
+        indexes = [
+            GinIndex(fields=["nummeraanduidingen"]),
+            GinIndex(fields=["panden"]),
+            GistIndex(fields=["straat", "huisnummers"]),
+        ]
         abstract = True
 
 
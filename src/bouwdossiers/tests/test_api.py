@@ -296,6 +296,31 @@ class TestAPI(APITestCase):
         self.assertEqual(response.data["results"][0]["titel"], "weesperstraat 113 - 117")
         delete_all_records()
 
+    def test_straat_huisnummer(self):
+        factories.AdresFactory(bouwdossier__dossiernr="111")  # weesperstraat 113 - 117
+        factories.AdresFactory(
+            bouwdossier__dossiernr="222", straat="weesperstraat", huisnummer_van=121, huisnummer_tot=None
+        )
+        factories.AdresFactory(bouwdossier__dossiernr="333", straat="sarphatistraat", huisnummer_van=101)
+
+        for query, dossiernrs in (
+            ("?straat=weesperstraat&huisnummer=115", ["111"]),
+            ("?straat=weesperstraat&huisnummer=117", ["111"]),
+            ("?straat=weesperstraat&huisnummer=121", ["222"]),
+            ("?straat=weesperstraat&huisnummer=119", []),
+            ("?straat=sarphatistraat&huisnummer=115", ["333"]),
+            ("?huisnummer=115", ["111", "333"]),
+            ("?straat=weesperstraat", ["111", "222"]),
+        ):
+            response = self.client.get(reverse("bouwdossier-list") + query)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(sorted(result["dossiernr"] for result in response.data["results"]), dossiernrs, query)
+
+        # A house number is not rounded down
+        response = self.client.get(reverse("bouwdossier-list") + "?straat=weesperstraat&huisnummer=115.7")
+        self.assertEqual(response.status_code, 400)
+        delete_all_records()
+
     def test_dossiernr_stadsdeel_max_datering_none(self):
         create_bouwdossiers(3)
         url = reverse("bouwdossier-list") + "?dossiernr=12345&stadsdeel=AA&max_datering=1997"
@@ -1,5 +1,6 @@
 import logging
 
+from django import forms
 from django.conf import settings
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import FilterSet, filters
@@ -13,6 +14,11 @@ from main.drf import HALPagination
 log = logging.getLogger(__name__)
 
 
+class IntegerFilter(filters.NumberFilter):
+    # NumberFilter accepts decimals, a decimal house number is an invalid value instead
+    field_class = forms.IntegerField
+
+
 class BouwDossierFilter(FilterSet):
     nummeraanduiding = filters.CharFilter(field_name="adressen__nummeraanduidingen", method="array_contains_filter")
     pand = filters.CharFilter(field_name="adressen__panden", method="array_contains_filter")
@@ -25,6 +31,8 @@ class BouwDossierFilter(FilterSet):
     dossier = filters.CharFilter(method="dossier_with_stadsdeel")
     stadsdeel = filters.CharFilter()
     dossier_type = filters.CharFilter()
+    straat = filters.CharFilter(method="adres_filter")
+    huisnummer = IntegerFilter(method="adres_filter")
 
     class Meta:
         model = BouwDossier
@@ -40,12 +48,29 @@ class BouwDossierFilter(FilterSet):
             "max_datering",
             "subdossier",
             "olo_liaan_nummer",
+            "straat",
+            "huisnummer",
         )
 
     def dossier_with_stadsdeel(self, queryset, _filter_name, value):
         stadsdeel, dossiernr = separate_dossier(value)
         return queryset.filter(stadsdeel=stadsdeel, dossiernr=dossiernr)
 
+    def adres_filter(self, queryset, _filter_name, _value):
+        # straat and huisnummer have to match the same adres, so they are filtered together.
+        # This uses the GiST index on straat and the huisnummers range of the adressen.
+        straat = self.form.cleaned_data.get("straat")
+        huisnummer = self.form.cleaned_data.get("huisnummer")
+        if _filter_name == "straat" and huisnummer is not None:
+            return queryset
+
+        adres_filter = {}
+        if straat:
+            adres_filter["adressen__straat"] = straat
+        if huisnummer is not None:
+            adres_filter["adressen__huisnummers__contains"] = huisnummer
+        return queryset.filter(**adres_filter).distinct()
+
     def array_contains_filter(self, queryset, _filter_name, value):
         if not isinstance(value, list):
             value = [value]
@@ -1,19 +1,43 @@
 import glob
+import hashlib
 import json
 import logging
+import multiprocessing
+import os
 import re
+import time
 import zlib
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import repeat
 
-import xmltodict
+import django
 from django.conf import settings
-from django.db import IntegrityError, connection, transaction
+from django.db import IntegrityError, connection, connections, transaction
 from django.db.models import Case, Count, IntegerField, Q, Sum, When
 
 import bouwdossiers.constants as const
+from bouwdossiers import models as bouwdossiers_models
 from importer import models
+from importer.util_azure import get_blob_container_client, open_blob
+from importer.util_bestand import normalize_bestand_url
+from importer.util_db import (
+    copy_import_files_between_apps,
+    copy_model_instances,
+    get_table_state,
+    log_query_plan,
+    update_table_state,
+)
+from importer.util_xml import iter_xml_items
 
 log = logging.getLogger(__name__)
 
+# Dossier xml files, e.g. .../WABO/SDC BWT/BWT_01.xml and .../SAA_BWT_02.xml
+WABO_FILE_RE = re.compile(r"/WABO/SD[A-Z]{1,2}( BWT)?/.+\.xml$")
+PRE_WABO_FILE_RE = re.compile(r"SAA_BWT_[A-Za-z-_0-9]+\.xml$")
+# The intern_nummer of a WABO dossier, e.g. sdz_prewabo_1274 or sdc_33
+WABO_INTERN_NUMMER_RE = re.compile(r"([A-Za-z]+)_(?:([A-Za-z]+)_)?(.*[\d-]+)")
+
 # This project now only uses the STADSDEEL codes received from the metadata xml files.
 # The decision was made to avoid confusion especially because the STADSDEEL
 # codes are used in the document names.
@@ -116,19 +140,275 @@ def openbaar_to_copyright(copyright):
     return const.COPYRIGHT_NO
 
 
-def get_dossier_access(_key, x_dossier, meta_ids: json):
+def get_dossier_access(_key, x_dossier, meta_ids: "MetaAdditions"):
     # match with parameter jsonfile meta_ids - bwt files have no get_access element in xml's
     # and some corrections are implemented in the jsonfile
-    _key_ids = meta_ids.get(_key, {})
-    if _key_ids == {}:
-        get_access(x_dossier)
+    if _key not in meta_ids:
         return get_access(x_dossier)
-    else:
-        _key_ids.get("dossier_access", const.ACCESS_RESTRICTED)
-        return _key_ids.get("dossier_access", const.ACCESS_RESTRICTED)
+    return meta_ids.get_dossier_access(_key)
+
+
+# The bag ids of an address in META_ADDITIONS.json
+MetaAdres = namedtuple("MetaAdres", ["panden", "verblijfsobjecten", "openbareruimte_id", "nummeraanduidingen"])
+
+
+class MetaAdditions:
+    """
+    Index over META_ADDITIONS.json. Per dossier key (e.g. SDC_1) it holds the dossier access
+    and the bag ids of the adressen by straat_huisnummer, so a lookup does not need a scan of
+    the adressen of the dossier. Only the fields that are used in the import are kept.
+    """
+
+    def __init__(self):
+        self.dossier_access = {}
+        self.adressen = {}
+
+    def __contains__(self, key):
+        return key in self.dossier_access
+
+    def __len__(self):
+        return len(self.dossier_access)
+
+    def add_dossier(self, key, dossier_access, adressen):
+        self.dossier_access[key] = dossier_access
+        for straat_huisnummer, adres in adressen:
+            # The first entry wins, as it did with the scan of the adressen list
+            self.adressen.setdefault((key, straat_huisnummer), adres)
+
+    def get_dossier_access(self, key):
+        return self.dossier_access.get(key)
+
+    def get_adres(self, key, straat_huisnummer):
+        return self.adressen.get((key, straat_huisnummer))
+
+    @classmethod
+    def load(cls, file):
+        meta_additions = cls()
+
+        def compact(item):
+            # Called for every json object from the inside out, so the adressen are compacted
+            # before the dossiers and the whole file are built.
+            if "straat_huisnummer" in item:
+                return item.get("straat_huisnummer"), MetaAdres(
+                    tuple(item.get("panden") or ()),
+                    tuple(item.get("verblijfsobjecten") or ()),
+                    item.get("openbareruimte_id"),
+                    tuple(item.get("nummeraanduidingen") or ()),
+                )
+            return item
+
+        for key, meta_dossier in json.load(file, object_hook=compact).items():
+            # Empty entries were ignored before as well
+            if meta_dossier:
+                meta_additions.add_dossier(
+                    key,
+                    meta_dossier.get("dossier_access", const.ACCESS_RESTRICTED),
+                    # An adres without straat_huisnummer was never found by a lookup, so it is
+                    # left out. Those are the ones that compact did not turn into a tuple.
+                    [adres for adres in meta_dossier.get("adressen") or [] if isinstance(adres, tuple)],
+                )
+        return meta_additions
+
+
+class DossierKeys:
+    """
+    The (stadsdeel, dossiernr) keys of the bouwdossiers that are imported, to prevent
+    duplicates before anything is written. Duplicate WABO dossiernrs get an 'X' added, up to
+    MAX_ATTEMPTS candidates. The keys of the file that is being imported are pending until
+    the file is committed, so a file that fails does not leave its keys behind.
+    """
 
+    # Number of dossiernrs that are tried for a WABO dossier when its dossiernr is already used
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, keys=()):
+        self.keys = set(keys)
+        self.pending = set()
+
+    @classmethod
+    def from_db(cls):
+        return cls(models.BouwDossier.objects.values_list("stadsdeel", "dossiernr"))
+
+    def __contains__(self, key):
+        return key in self.keys or key in self.pending
+
+    def claim(self, bouwdossier, file_path):
+        """
+        Reserve the key of the bouwdossier. Returns False when a WABO dossier has no free
+        dossiernr left. A duplicate of any other dossier raises an IntegrityError, the same as
+        the database would.
+        """
+        dossier = f"{bouwdossier.stadsdeel}_{bouwdossier.dossiernr}"
+        original_dossiernr = bouwdossier.dossiernr
+
+        if bouwdossier.source != const.SOURCE_WABO:
+            if (bouwdossier.stadsdeel, original_dossiernr) in self:
+                raise IntegrityError(f"Duplicate dossier {dossier} in {file_path}")
+            self.pending.add((bouwdossier.stadsdeel, original_dossiernr))
+            return True
 
-def add_wabo_dossier(x_dossier, file_path, import_file, count, total_count, meta_ids: json = None):  # noqa C901
+        for attempt in range(self.MAX_ATTEMPTS):
+            dossiernr = original_dossiernr + ("X" * attempt)
+            if (bouwdossier.stadsdeel, dossiernr) not in self:
+                bouwdossier.dossiernr = dossiernr
+                self.pending.add((bouwdossier.stadsdeel, dossiernr))
+                return True
+            log.warning(f"Duplicate key on attempt {attempt + 1} for {dossier} in {file_path}")
+
+        log.error(f"All {self.MAX_ATTEMPTS} dossiernrs are already used for {dossier} in {file_path}")
+        return False
+
+    def commit(self):
+        self.keys |= self.pending
+        self.pending = set()
+
+    def rollback(self):
+        self.pending = set()
+
+
+class ImportCounters(Counter):
+    """
+    The numbers of adressen that validate_import checks, kept up to date while the dossiers
+    are loaded and matched, so they do not have to be counted afterwards. The keys are those
+    of the validation result, e.g. total, has_panden, wabo_has_panden and prewabo_total.
+    """
+
+    SOURCE_PREFIXES = {const.SOURCE_WABO: "wabo", const.SOURCE_EDEPOT: "prewabo"}
+    FIELDS = ("total", "has_panden", "has_nummeraanduidingen", "has_openbareruimte_id")
+
+    def add(self, source, field, count=1):
+        self[field] += count
+        if source in self.SOURCE_PREFIXES:
+            self[f"{self.SOURCE_PREFIXES[source]}_{field}"] += count
+
+    def add_adres(self, bouwdossier, adres):
+        self.add(bouwdossier.source, "total")
+        if bouwdossier.wabo_bron == "BWT":
+            self["wabo_bwt"] += 1
+        if adres.panden:
+            self.add(bouwdossier.source, "has_panden")
+        if adres.nummeraanduidingen:
+            self.add(bouwdossier.source, "has_nummeraanduidingen")
+        if adres.openbareruimte_id:
+            self.add(bouwdossier.source, "has_openbareruimte_id")
+
+    def as_result(self):
+        # All keys, also those that were never counted
+        keys = ["wabo_bwt"] + [f"{prefix}{field}" for prefix in ["", "wabo_", "prewabo_"] for field in self.FIELDS]
+        return {key: self[key] for key in keys}
+
+    @classmethod
+    def from_db(cls):
+        """
+        Count the adressen in the importer tables, e.g. to start from the adressen that were
+        copied from the previous import or imported before an import was resumed.
+        """
+        has_panden = Case(When(panden__len__gt=0, then=1), default=0, output_field=IntegerField())
+        has_nummeraanduidingen = Case(
+            When(nummeraanduidingen__len__gt=0, then=1), default=0, output_field=IntegerField()
+        )
+        has_openbareruimte_id = Case(
+            When(~Q(openbareruimte_id__isnull=True) & ~Q(openbareruimte_id=""), then=1),
+            default=0,
+            output_field=IntegerField(),
+        )
+        aggregates = {
+            "total": Count("id"),
+            "has_panden": Sum(has_panden),
+            "has_nummeraanduidingen": Sum(has_nummeraanduidingen),
+            "has_openbareruimte_id": Sum(has_openbareruimte_id),
+            "wabo_bwt": Count("id", filter=Q(bouwdossier__wabo_bron="BWT")),
+        }
+        for source, prefix in cls.SOURCE_PREFIXES.items():
+            source_filter = Q(bouwdossier__source=source)
+            aggregates[f"{prefix}_total"] = Count("id", filter=source_filter)
+            aggregates[f"{prefix}_has_panden"] = Sum(has_panden, filter=source_filter)
+            aggregates[f"{prefix}_has_nummeraanduidingen"] = Sum(has_nummeraanduidingen, filter=source_filter)
+            aggregates[f"{prefix}_has_openbareruimte_id"] = Sum(has_openbareruimte_id, filter=source_filter)
+
+        result = models.Adres.objects.aggregate(**aggregates)
+        # Sum gives None for no rows at all
+        return cls({key: value or 0 for key, value in result.items()})
+
+
+class DossierWriter:
+    """
+    Collects bouwdossiers with their adressen and documenten and writes them to the database
+    in batches. Each batch takes one bulk insert per model. The bouwdossier primary keys are
+    returned by the first insert, after which the adressen and documenten get their foreign keys.
+    Duplicate dossiers are resolved by DossierKeys before they are added to a batch.
+    The written adressen are counted in `counters`.
+    """
+
+    def __init__(self, file_path, dossier_keys, batch_size=settings.IMPORT_BATCH_SIZE):
+        self.file_path = file_path
+        self.dossier_keys = dossier_keys
+        self.batch_size = batch_size
+        self.counters = ImportCounters()
+        self.bouwdossiers = []
+        self.adressen = []
+        self.documenten = []
+
+    def add(self, bouwdossier, adressen, documenten):
+        """Add a bouwdossier to the batch. Returns False when it is skipped as a duplicate."""
+        if not self.dossier_keys.claim(bouwdossier, self.file_path):
+            return False
+
+        for adres in adressen:
+            self.counters.add_adres(bouwdossier, adres)
+        self.bouwdossiers.append(bouwdossier)
+        self.adressen.extend(adressen)
+        self.documenten.extend(documenten)
+        if len(self.bouwdossiers) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self.bouwdossiers:
+            return
+
+        self.write_batch()
+
+        self.bouwdossiers = []
+        self.adressen = []
+        self.documenten = []
+
+    def write_batch(self):
+        models.BouwDossier.objects.bulk_create(self.bouwdossiers)
+        models.Adres.objects.bulk_create(self.adressen)
+        models.Document.objects.bulk_create(self.documenten)
+
+
+class CopyDossierWriter(DossierWriter):
+    """
+    DossierWriter that loads each batch with COPY instead of INSERT statements. The
+    bouwdossier ids are reserved from the id sequence up front, so the foreign keys of the
+    adressen and documenten are known before anything is sent to the database.
+    """
+
+    def write_batch(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [models.BouwDossier._meta.db_table, len(self.bouwdossiers)],
+            )
+            for bouwdossier, (pk,) in zip(self.bouwdossiers, cursor.fetchall()):
+                bouwdossier.pk = pk
+            for obj in self.adressen + self.documenten:
+                obj.bouwdossier_id = obj.bouwdossier.pk
+
+            copy_model_instances(cursor, models.BouwDossier, self.bouwdossiers)
+            copy_model_instances(cursor, models.Adres, self.adressen)
+            copy_model_instances(cursor, models.Document, self.documenten)
+
+
+DOSSIER_WRITERS = {
+    "orm": DossierWriter,
+    "copy": CopyDossierWriter,
+}
+
+
+def add_wabo_dossier(x_dossier, file_path, import_file, writer, count, total_count, meta_ids: MetaAdditions = None):  # noqa C901
     """
     For information about wabo and pre_wabo please check the README
     Add wabo dossier to the the bouwdossier model. Structure of import is
@@ -144,7 +424,7 @@ def add_wabo_dossier(x_dossier, file_path, import_file, count, total_count, meta
     # The intern number can be something like sdz_prewabo_1274 or sdc_33
     # If prewabo is present it is a prewabo dossier.
     dossier = x_dossier.get("intern_nummer")
-    m = re.match(r"([A-Za-z]+)_(?:([A-Za-z]+)_)?(.*[\d-]+)", dossier)
+    m = WABO_INTERN_NUMMER_RE.match(dossier)
     if not m:
         log.error(f"Invalid intern_nummer {dossier} in {file_path}")
         return count, total_count
@@ -213,35 +493,7 @@ def add_wabo_dossier(x_dossier, file_path, import_file, count, total_count, meta
         activiteiten=activiteiten,
     )
 
-    # Save bouwdossier and try adding 'X' when double dossiernrs
-    MAX_ATTEMPTS = 3
-    success = False
-    original_dossiernr = bouwdossier.dossiernr  # Store the original value
-
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            with transaction.atomic():
-                bouwdossier.save()
-                success = True
-                break
-        except IntegrityError as e:
-            if "duplicate key" in str(e).lower():
-                log.warning(f"Duplicate key error on attempt {attempt} for {dossier} in {file_path}: {e}")
-                bouwdossier.dossiernr = original_dossiernr + ("X" * attempt)
-            else:
-                log.error(f"Non-retryable IntegrityError for {dossier} in {file_path}: {e}")
-                return count, total_count
-
-    if not success:
-        log.error(f"All {MAX_ATTEMPTS} save attempts failed for {dossier} in {file_path}")
-        return count, total_count
-
-    count += 1
-    total_count += 1
-
-    if total_count % 1000 == 0:
-        log.info(f"Bouwdossiers count in file: {count}, total: {total_count}")
-
+    adressen = []
     for x_adres in get_list_items(x_dossier, "locaties", "locatie"):
         bag_id = x_adres.get("bag_id")
         panden = []
@@ -258,15 +510,13 @@ def add_wabo_dossier(x_dossier, file_path, import_file, count, total_count, meta
         elif x_adres.get("straatnaam") and x_adres.get("huisnummer"):
             # when no bag_ids in xml, try match straat&huisnummer with parameter meta_ids jsonfile
             _straat_huisnummer = x_adres.get("straatnaam") + "_" + x_adres.get("huisnummer")
-            _adressen = meta_ids.get(_key, {}).get("adressen", [])
-            try:
-                _result = [item for item in _adressen if item.get("straat_huisnummer") == _straat_huisnummer.lower()][0]
-
-                [panden.append(item) for item in _result["panden"]]
-                [verblijfsobjecten.append(item) for item in _result["verblijfsobjecten"]]
-                openbareruimte_id = _result["openbareruimte_id"]
-                [nummeraanduidingen.append(item) for item in _result["nummeraanduidingen"]]
-            except:
+            _result = meta_ids.get_adres(_key, _straat_huisnummer.lower())
+            if _result:
+                panden.extend(_result.panden)
+                verblijfsobjecten.extend(_result.verblijfsobjecten)
+                openbareruimte_id = _result.openbareruimte_id
+                nummeraanduidingen.extend(_result.nummeraanduidingen)
+            else:
                 log.info(
                     f"straat_huisnummer niet gevonden in BWT_TMLO.json voor {_key}:{_straat_huisnummer} in {file_path}"
                 )
@@ -291,7 +541,7 @@ def add_wabo_dossier(x_dossier, file_path, import_file, count, total_count, meta
             verblijfsobjecten_label=[],
             locatie_aanduiding=locatie_aanduiding,
         )
-        adres.save()
+        adressen.append(adres)
 
     documenten = []
     for x_document in get_list_items(x_dossier, "documenten", "document"):
@@ -303,37 +553,7 @@ def add_wabo_dossier(x_dossier, file_path, import_file, count, total_count, meta
             # to keep the same structure as the pre_wabo dossiers.
             # The removed part below is because we want to be consistent with the pre-wabo urls
             # in that we only store a relative url, not the full url
-            bestand_str = bestand.get("URL")
-            for base_url in settings.WABO_BASE_URL:
-                bestand_str = bestand_str.replace(base_url, "")
-
-            ## the bestand_url from metadata is not what it should be, construct correctly here
-            # catch the dossiertype from existence in bestand_str
-            b = re.search(r"(SquitXO|KEY2|Decos|BWT)", bestand_str)
-            if b:
-                b_type = b.group(1)
-                mapping = {
-                    "KEY2": "Key2",
-                    "SquitXO": "SquitXO",
-                    "Decos": "Decos",
-                    "BWT": "Decos",
-                }
-                bestand_type = mapping[b_type]
-
-                _parts = bestand_str.split("/")
-
-                if "BWT" in _parts[0]:  # then it's from WABO/BWT and different url-format
-                    _parts[0] = _parts[0].replace(" ", "/")
-                    bestand_str = "/".join(_parts)
-                else:  # place the file directly under dossier by removing folder before filename
-                    _parts.pop(-2)
-                    bestand_str = "/".join(_parts)
-                    # add dossiertype after stadsdeel
-                    bestand_str = re.sub(
-                        rf"^{bouwdossier.stadsdeel}/",
-                        f"{bouwdossier.stadsdeel}/{bestand_type}/",
-                        bestand_str,
-                    )
+            bestand_str = normalize_bestand_url(bestand.get("URL"), bouwdossier.stadsdeel)
 
             if type(bestand_str) is str and len(bestand_str) > 250:
                 # Bestand urls longer than 250 characters are not supported by the DB. Since only one in about 200.000
@@ -396,14 +616,19 @@ def add_wabo_dossier(x_dossier, file_path, import_file, count, total_count, meta
 
         documenten.append(document)
 
-    if len(documenten) > 0:
-        models.Document.objects.bulk_create(documenten)
-    else:
+    if len(documenten) == 0:
         log.warning(f"No documenten for for {bouwdossier.dossiernr} in {file_path}")
+
+    # Only the dossiers that are written are counted, not the duplicates that are skipped
+    if writer.add(bouwdossier, adressen, documenten):
+        count += 1
+        total_count += 1
+        if total_count % 1000 == 0:
+            log.info(f"Bouwdossiers count in file: {count}, total: {total_count}")
     return count, total_count
 
 
-def add_pre_wabo_dossier(x_dossier, file_path, import_file, count, total_count, meta_ids: json = None):  # noqa C901
+def add_pre_wabo_dossier(x_dossier, file_path, import_file, writer, count, total_count, meta_ids: MetaAdditions = None):  # noqa C901
     """
     For information about wabo and pre_wabo please check the README
     """
@@ -438,13 +663,8 @@ def add_pre_wabo_dossier(x_dossier, file_path, import_file, count, total_count,
         access=access,
         access_restricted_until=access_restricted_until,
     )
-    bouwdossier.save()
-    count += 1
-    total_count += 1
-
-    if total_count % 1000 == 0:
-        log.info(f"Bouwdossiers count in file: {count}, total: {total_count}")
 
+    adressen = []
     for x_adres in get_list_items(x_dossier, "adressen", "adres"):
         huisnummer_van = x_adres.get("huisnummerVan")
         huisnummer_van = int(huisnummer_van) if huisnummer_van else None
@@ -463,8 +683,9 @@ def add_pre_wabo_dossier(x_dossier, file_path, import_file, count, total_count,
             verblijfsobjecten=[],
             verblijfsobjecten_label=[],
         )
-        adres.save()
+        adressen.append(adres)
 
+    all_documenten = []
     for x_sub_dossier in get_list_items(x_dossier, "subDossiers", "subDossier"):
         titel = x_sub_dossier["titel"]
 
@@ -513,164 +734,753 @@ def add_pre_wabo_dossier(x_dossier, file_path, import_file, count, total_count,
             documenten.append(document)
 
         if len(documenten) > 0:
-            models.Document.objects.bulk_create(documenten)
+            all_documenten.extend(documenten)
         else:
             log.warning(f"No documenten for for {bouwdossier.dossiernr} in {file_path}")
 
+    # Only the dossiers that are written are counted, not the duplicates that are skipped
+    if writer.add(bouwdossier, adressen, all_documenten):
+        count += 1
+        total_count += 1
+        if total_count % 1000 == 0:
+            log.info(f"Bouwdossiers count in file: {count}, total: {total_count}")
     return count, total_count
 
 
-def _read_meta_additions_dossiers(file_path) -> dict:
-    log.info("read BTW wabo dossiers verblijfsobjecten_ids from json file")
-    with open(file_path, "r") as file:
-        data = json.load(file)
+class FileSource:
+    """
+    The dossier files in the directory root_dir. A source lists the xml files in it, and
+    opens files as binary file objects.
+    """
+
+    def __init__(self, root_dir=settings.DATA_DIR):
+        self.root_dir = root_dir
+
+    def list_files(self):
+        return glob.glob(self.root_dir + "/**/*.xml", recursive=True)
+
+    def get_size(self, file_path):
+        return os.path.getsize(file_path)
+
+    def get_etag(self, file_path):
+        """The ETag of the file, None when the source has no ETags"""
+        return None
+
+    def open(self, file_path):
+        return open(file_path, "rb")
+
+
+class BlobSource(FileSource):
+    """
+    The dossier files in a blob container, read straight from the blob storage without
+    storing them on disk. The files are named as if the container was downloaded to
+    root_dir, so they are classified and recorded in ImportFile the same way as local files.
+    """
+
+    def __init__(self, container_name, root_dir=settings.DATA_DIR):
+        super().__init__(root_dir)
+        self.container_name = container_name
+        self._sizes = {}
+        self._etags = {}
+        self._container_client = None
+
+    def __getstate__(self):
+        # The client is not passed on to import worker processes, they create their own
+        return {**self.__dict__, "_container_client": None}
+
+    @property
+    def container_client(self):
+        if self._container_client is None:
+            self._container_client = get_blob_container_client(self.container_name)
+        return self._container_client
+
+    def list_files(self):
+        blobs = {
+            f"{self.root_dir}/{blob.name}": blob
+            for blob in self.container_client.list_blobs()
+            if blob.name.endswith(".xml")
+        }
+        self._sizes = {file_path: blob.size for file_path, blob in blobs.items()}
+        self._etags = {file_path: blob.etag for file_path, blob in blobs.items()}
+        return list(blobs)
+
+    def get_size(self, file_path):
+        return self._sizes[file_path]
+
+    def get_etag(self, file_path):
+        return self._etags.get(file_path)
+
+    def open(self, file_path):
+        return open_blob(self.container_client, os.path.relpath(file_path, self.root_dir))
+
+
+class DigestReader:
+    """
+    Wrap a binary file object and compute the sha256 digest and the size of everything that
+    is read from it, so a file that is streamed is hashed without reading it twice.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
         return data
 
+    def read_to_end(self):
+        while self.read(1024 * 1024):
+            pass
+        return self.sha256.hexdigest(), self.size
+
+
+def _read_meta_additions_dossiers(file_path, source=None) -> MetaAdditions:
+    log.info("read BTW wabo dossiers verblijfsobjecten_ids from json file")
+    with (source or FileSource()).open(file_path) as file:
+        return MetaAdditions.load(file)
+
 
-def _get_meta_additions(root_dir) -> dict:
+def _get_meta_additions(root_dir, source=None) -> MetaAdditions:
     try:
         meta_filepath = root_dir + "/META_ADDITIONS/META_ADDITIONS.json"
-        meta_ids = _read_meta_additions_dossiers(meta_filepath)
+        meta_ids = _read_meta_additions_dossiers(meta_filepath, source)
         return meta_ids
     except FileNotFoundError:
         log.error(f"Wabo-bwt bag_id verrijkingsfile staat niet op de juist plek: {meta_filepath}")
 
 
-def import_wabo_dossiers(root_dir=settings.DATA_DIR, max_file_count=None):  # noqa C901
+def get_file_digest(file_path, source=None):
+    """
+    Return the sha256 hex digest and the size of a file
+    """
+    with (source or FileSource()).open(file_path) as f:
+        return DigestReader(f).read_to_end()
+
+
+def import_dossier_file(
+    file_path,
+    add_dossier,
+    meta_ids,
+    total_count=0,
+    batch_size=settings.IMPORT_BATCH_SIZE,
+    writer=settings.IMPORT_WRITER,
+    dossier_keys=None,
+    conflicts=None,
+    source=None,
+    counters=None,
+    stems=None,
+):
+    """
+    Import all dossiers in a single xml file within one transaction and keep track of
+    the progress in ImportFile. The file is parsed as a stream, one dossier at a time, and
+    hashed while it is parsed. `writer` is the name of the DOSSIER_WRITERS entry used to
+    write the dossiers, `source` the FileSource the file is read from.
+    Returns the number of imported dossiers, or None when the file could not be imported.
+
+    When a `conflicts` list is given, a file that fails on a duplicate key in the database
+    is not marked as failed but removed again and added to the list, to be imported later.
+    The adressen of an imported file are added to `counters`, the dossier stems of its
+    dossiers to the `stems` set.
+    """
+    if dossier_keys is None:
+        dossier_keys = DossierKeys.from_db()
+    if source is None:
+        source = FileSource()
+
+    import_file = models.ImportFile(name=file_path, status=const.IMPORT_BUSY)
+    import_file.save()
+
+    try:
+        log.info(f"Processing - {file_path}")
+        count = 0
+
+        dossier_writer = DOSSIER_WRITERS[writer](file_path, dossier_keys, batch_size)
+        with source.open(file_path) as file, transaction.atomic():
+            reader = DigestReader(file)
+            for x_dossier in iter_xml_items(reader, "dossier"):
+                if stems is not None:
+                    stems.add(DOSSIER_STEMS[add_dossier](x_dossier))
+                (count, total_count) = add_dossier(
+                    x_dossier, file_path, import_file, dossier_writer, count, total_count, meta_ids
+                )
+            dossier_writer.flush()
+            import_file.content_hash, import_file.size = reader.read_to_end()
+            import_file.etag = source.get_etag(file_path)
+
+        dossier_keys.commit()
+        if stems is not None:
+            # Dossiers without a valid number are not imported
+            stems.discard(None)
+        import_file.status = const.IMPORT_FINISHED
+        import_file.save()
+        if counters is not None:
+            counters.update(dossier_writer.counters)
+        return count
+
+    except Exception as e:
+        dossier_keys.rollback()
+        if conflicts is not None and isinstance(e, IntegrityError):
+            log.warning(f"Duplicate dossier while processing file {file_path}, it will be imported again later: {e}")
+            import_file.delete()
+            conflicts.append(file_path)
+            return None
+
+        log.error(f"Error while processing file {file_path} : {e}")
+        import_file.status = const.IMPORT_ERROR
+        import_file.save()
+        return None
+
+
+def get_wabo_dossier_stem(x_dossier):
+    """
+    The (stadsdeel, dossiernr) of a WABO dossier without the 'X' suffixes of duplicates. It
+    is coarser than the key of the bouwdossier, which only makes more files share a stem.
+    """
+    m = WABO_INTERN_NUMMER_RE.match(x_dossier.get("intern_nummer") or "")
+    return m and (m.group(1).upper(), m.group(3).rstrip("X"))
+
+
+def get_pre_wabo_dossier_stem(x_dossier):
+    """The (stadsdeel, dossiernr) of a pre-WABO dossier"""
+    return x_dossier.get("stadsdeelcode") or "", (x_dossier.get("dossierNr") or "").zfill(5)
+
+
+# The dossier stem of the dossiers of each add_dossier function
+DOSSIER_STEMS = {
+    add_wabo_dossier: get_wabo_dossier_stem,
+    add_pre_wabo_dossier: get_pre_wabo_dossier_stem,
+}
+
+
+def _init_import_worker(database_name):
+    """
+    Initializer of an import worker process. Workers are started from a fresh process
+    instead of a fork, as forking a process that runs other threads can deadlock. The
+    database name is passed on because the test runner changes it at runtime.
+    """
+    django.setup()
+    connection.settings_dict["NAME"] = database_name
+
+
+def _read_dossier_stems(file_path, dossier_stem, source):
+    """Return the dossier stems of all dossiers in a file"""
+    with source.open(file_path) as file:
+        stems = {dossier_stem(x_dossier) for x_dossier in iter_xml_items(file, "dossier")}
+    # Dossiers without a valid number are not imported
+    stems.discard(None)
+    return stems
+
+
+def _import_file_shard(file_paths, add_dossier, meta_ids, batch_size, writer, source):
+    """
+    Entry point of an import worker process. The worker opens its own database connection
+    and imports its shard of the files one by one, each file in its own transaction.
+    The keys of the dossiers imported by other workers at the same time are not known in this
+    worker, so files that do run into one of those are returned to be imported afterwards.
+    Returns the (count, dossier stems, counters) of every imported file and the failed files.
+    """
     total_count = 0
-    file_count = 0
+    results = {}
+    conflicts = []
+    try:
+        dossier_keys = DossierKeys.from_db()
+        for file_path in file_paths:
+            stems = set()
+            counters = ImportCounters()
+            count = import_dossier_file(
+                file_path,
+                add_dossier,
+                meta_ids,
+                total_count,
+                batch_size,
+                writer,
+                dossier_keys,
+                conflicts,
+                source,
+                counters,
+                stems,
+            )
+            if count is not None:
+                total_count += count
+                results[file_path] = (count, stems, counters)
+    finally:
+        connections.close_all()
+    return results, conflicts
+
 
-    meta_ids = _get_meta_additions(root_dir)
+def _shard_files(file_paths, workers, source):
+    # Deal out the files from large to small so every worker gets a comparable amount of work
+    file_paths = sorted(file_paths, key=source.get_size, reverse=True)
+    return [file_paths[i::workers] for i in range(min(workers, len(file_paths)))]
 
-    for file_path in glob.iglob(root_dir + "/**/*.xml", recursive=True):
-        wabo = re.search(r"/WABO/SD[A-Z]{1,2}( BWT)?/.+\.xml$", file_path)
-        importfiles = models.ImportFile.objects.filter(name=file_path)
 
-        if not wabo or len(importfiles) > 0:
+def _import_files_parallel(file_paths, add_dossier, meta_ids, workers, batch_size, writer, source, counters):
+    """
+    Import the files in worker processes, with the same result as a serial import in the
+    order of file_paths. Which duplicate dossier keeps the plain dossiernr and which one gets
+    an 'X' depends on the order of the files, so the workers report the dossier stems of the
+    files they imported, and the files with dossiers that also occur in another file are
+    removed again and imported in that order afterwards.
+    """
+    database_name = connection.settings_dict["NAME"]
+    # Every worker opens a database connection of its own
+    connections.close_all()
+
+    results = {}
+    conflicts = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_import_worker,
+        initargs=(database_name,),
+    ) as executor:
+        shards = _shard_files(file_paths, workers, source)
+        log.info(f"Importing {len(file_paths)} files using {len(shards)} workers")
+        futures = [
+            executor.submit(_import_file_shard, shard, add_dossier, meta_ids, batch_size, writer, source)
+            for shard in shards
+        ]
+        for future in as_completed(futures):
+            shard_results, shard_conflicts = future.result()
+            results.update(shard_results)
+            conflicts.extend(shard_conflicts)
+            log.info(
+                f"Import in process. Imported files: {len(results)}. "
+                f"Imported dossiers: {sum(count for count, _, _ in results.values())}"
+            )
+
+        # A file that failed on a duplicate dossier was not imported completely, so only the
+        # dossier stems of these files have to be read separately
+        file_stems = {file_path: stems for file_path, (_, stems, _) in results.items()}
+        file_stems.update(
+            zip(
+                conflicts,
+                executor.map(_read_dossier_stems, conflicts, repeat(DOSSIER_STEMS[add_dossier]), repeat(source)),
+            )
+        )
+
+    stem_counts = Counter(stem for stems in file_stems.values() for stem in stems)
+    reimports = set(conflicts)
+    for file_path, stems in file_stems.items():
+        if any(stem_counts[stem] > 1 for stem in stems):
+            reimports.add(file_path)
+
+    if reimports:
+        log.info(f"Importing {len(reimports)} files with dossiers that occur in other files again")
+        models.ImportFile.objects.filter(name__in=reimports - set(conflicts)).delete()
+
+    file_count = 0
+    total_count = 0
+    for file_path, (count, _, file_counters) in results.items():
+        if file_path not in reimports:
+            file_count += 1
+            total_count += count
+            counters.update(file_counters)
+
+    # None of the files that are in the database now shares a dossier with these, so importing
+    # them in the order of file_paths gives the 'X' to the same dossiers as a serial import
+    dossier_keys = DossierKeys.from_db()
+    for file_path in file_paths:
+        if file_path not in reimports:
             continue
+        count = import_dossier_file(
+            file_path,
+            add_dossier,
+            meta_ids,
+            total_count,
+            batch_size,
+            writer,
+            dossier_keys,
+            source=source,
+            counters=counters,
+        )
+        if count is not None:
+            file_count += 1
+            total_count += count
+    return file_count, total_count
 
-        import_file = models.ImportFile(name=file_path, status=const.IMPORT_BUSY)
-        import_file.save()
 
-        try:
-            log.info(f"Processing - {file_path}")
-            count = 0
+def set_import_unfinished(unfinished):
+    """
+    Mark the importer tables as holding an import that is not finished, or clear the mark
+    before the tables are swapped. Only an unfinished import can be resumed. The mark is kept
+    in the state of the ImportFile table, so it does not need a table of its own that would
+    have to be swapped with the bouwdossiers tables as well.
+    """
+    update_table_state(models.ImportFile._meta.db_table, unfinished_import=True if unfinished else None)
 
-            #  This is temporarily fetched from the object store
-            #  In the future, we will be pulling this from the client's webserver
 
-            with open(file_path) as fd:
-                xml = xmltodict.parse(fd.read())
+def is_import_unfinished():
+    return get_table_state(models.ImportFile._meta.db_table).get("unfinished_import", False)
 
-            with transaction.atomic():
-                for x_dossier in get_list_items(xml, "dossiers", "dossier"):
-                    (count, total_count) = add_wabo_dossier(
-                        x_dossier, file_path, import_file, count, total_count, meta_ids
-                    )
 
-            import_file.status = const.IMPORT_FINISHED
-            import_file.save()
-            file_count += 1
-            if max_file_count and file_count >= max_file_count:
-                break
+def reset_unfinished_files():
+    """
+    Prepare resuming an import that was interrupted. The finished and failed files are kept,
+    the files that were still being imported are removed together with anything that was
+    written for them, so the directory scan picks them up again.
+    Returns the number of removed files.
+    """
+    unfinished_files = models.ImportFile.objects.filter(status=const.IMPORT_BUSY)
+    unfinished_count = unfinished_files.count()
+    unfinished_files.delete()
+
+    finished_count = models.ImportFile.objects.filter(status=const.IMPORT_FINISHED).count()
+    log.info(f"Resuming import with {finished_count} finished files, {unfinished_count} unfinished files are removed")
+    return unfinished_count
+
+
+def copy_unchanged_files(root_dir=settings.DATA_DIR, source=None):
+    """
+    For an incremental import: copy the import files that did not change since the previous
+    import, with all their dossiers, forward from the bouwdossiers tables into the importer
+    tables. The copied files are then skipped by scan_dossier_files, so only new and changed
+    files are parsed. Files that were removed are not copied, which drops their dossiers.
+    Returns the number of copied files.
+
+    Only pre-WABO files are copied. Their adressen get all their bag ids from the matching,
+    so the bag ids of the previous import are cleared and the adressen are matched again
+    against the current BAG, the same as in a full import. The bag ids of WABO adressen come
+    partly from the xml and META_ADDITIONS.json and partly from the matching, which can not be
+    told apart afterwards, so WABO files are always imported again.
+    """
+    previous_files = {
+        name: (importfile_id, content_hash, size, etag)
+        for importfile_id, name, content_hash, size, etag in bouwdossiers_models.ImportFile.objects.filter(
+            status=const.IMPORT_FINISHED, content_hash__isnull=False
+        ).values_list("id", "name", "content_hash", "size", "etag")
+    }
 
-        except Exception as e:
-            log.error(f"Error while processing file {file_path} : {e}")
-            import_file.status = const.IMPORT_ERROR
-            import_file.save()
+    if source is None:
+        source = FileSource(root_dir)
 
+    unchanged_ids = []
+    for file_path in source.list_files():
+        if file_path not in previous_files or not PRE_WABO_FILE_RE.search(file_path):
+            continue
+        importfile_id, content_hash, size, etag = previous_files[file_path]
+        # A blob changes its ETag when it is written, so a blob does not have to be downloaded
+        # to be hashed when the previous import recorded its ETag
+        if etag and source.get_etag(file_path):
+            if source.get_etag(file_path) == etag:
+                unchanged_ids.append(importfile_id)
+        # Only files with an unchanged size need to be hashed
+        elif source.get_size(file_path) == size and get_file_digest(file_path, source)[0] == content_hash:
+            unchanged_ids.append(importfile_id)
+
+    copy_import_files_between_apps("bouwdossiers", "importer", unchanged_ids)
+    models.Adres.objects.filter(bouwdossier__importfile_id__in=unchanged_ids).update(
+        panden=[],
+        verblijfsobjecten=[],
+        verblijfsobjecten_label=[],
+        nummeraanduidingen=[],
+        nummeraanduidingen_label=[],
+        openbareruimte_id=None,
+    )
     log.info(
-        f"Import finished. Bouwdossiers total: {total_count}. Bouwdossiers count query: {models.BouwDossier.objects.count()}"
+        f"Copied {len(unchanged_ids)} unchanged files from the previous import, "
+        f"{len(previous_files) - len(unchanged_ids)} files are imported again or removed"
     )
+    return len(unchanged_ids)
 
 
-def import_pre_wabo_dossiers(root_dir=settings.DATA_DIR, max_file_count=None):  # noqa C901
+def scan_dossier_files(root_dir=settings.DATA_DIR, source=None):
+    """
+    Walk the dossier directory, or list the files of another source, once and return the
+    WABO and the pre-WABO xml files that have not been imported yet, as two lists. The names
+    of the imported files are loaded up front, so no query is needed per file.
+    """
+    if source is None:
+        source = FileSource(root_dir)
+    imported_files = set(models.ImportFile.objects.values_list("name", flat=True))
+
+    wabo_file_paths = []
+    pre_wabo_file_paths = []
+    # Sorted, so duplicate dossiers get their 'X' in the same files in every import
+    for file_path in sorted(source.list_files()):
+        if file_path in imported_files:
+            continue
+        # Pre-WABO goes first, the pre-WABO import has always been run before the WABO import
+        if PRE_WABO_FILE_RE.search(file_path):
+            pre_wabo_file_paths.append(file_path)
+        elif WABO_FILE_RE.search(file_path):
+            wabo_file_paths.append(file_path)
+
+    log.info(f"Found {len(wabo_file_paths)} WABO and {len(pre_wabo_file_paths)} pre-WABO files to import")
+    return wabo_file_paths, pre_wabo_file_paths
+
+
+def import_wabo_dossiers(
+    root_dir=settings.DATA_DIR,
+    max_file_count=None,
+    workers=1,
+    batch_size=settings.IMPORT_BATCH_SIZE,
+    writer=settings.IMPORT_WRITER,
+    file_paths=None,
+    source=None,
+    counters=None,
+):  # noqa C901
     total_count = 0
     file_count = 0
 
-    meta_ids = _get_meta_additions(root_dir)
+    if source is None:
+        source = FileSource(root_dir)
+    if counters is None:
+        counters = ImportCounters()
 
-    for file_path in glob.iglob(root_dir + "/**/*.xml", recursive=True):
-        # SAA_BWT_02.xml
-        pre_wabo = re.search(r"SAA_BWT_[A-Za-z-_0-9]+\.xml$", file_path)
-        importfiles = models.ImportFile.objects.filter(name=file_path)
+    meta_ids = _get_meta_additions(root_dir, source)
 
-        if not pre_wabo or len(importfiles) > 0:
-            continue
+    if file_paths is None:
+        file_paths, _ = scan_dossier_files(root_dir, source)
 
-        import_file = models.ImportFile(name=file_path, status=const.IMPORT_BUSY)
-        import_file.save()
+    if max_file_count:
+        file_paths = file_paths[:max_file_count]
+
+    #  This is temporarily fetched from the object store
+    #  In the future, we will be pulling this from the client's webserver
+
+    if workers > 1:
+        file_count, total_count = _import_files_parallel(
+            file_paths, add_wabo_dossier, meta_ids, workers, batch_size, writer, source, counters
+        )
+    else:
+        dossier_keys = DossierKeys.from_db()
+        for file_path in file_paths:
+            count = import_dossier_file(
+                file_path,
+                add_wabo_dossier,
+                meta_ids,
+                total_count,
+                batch_size,
+                writer,
+                dossier_keys,
+                source=source,
+                counters=counters,
+            )
+            if count is not None:
+                total_count += count
+                file_count += 1
+
+    log.info(
+        f"Import finished. Bouwdossiers total: {total_count}. Bouwdossiers count query: {models.BouwDossier.objects.count()}"
+    )
 
-        try:
-            log.info(f"Processing - {file_path}")
-            count = 0
 
-            with open(file_path) as fd:
-                xml = xmltodict.parse(fd.read())
+def import_pre_wabo_dossiers(
+    root_dir=settings.DATA_DIR,
+    max_file_count=None,
+    workers=1,
+    batch_size=settings.IMPORT_BATCH_SIZE,
+    writer=settings.IMPORT_WRITER,
+    file_paths=None,
+    source=None,
+    counters=None,
+):  # noqa C901
+    total_count = 0
+    file_count = 0
 
-            with transaction.atomic():
-                for x_dossier in get_list_items(xml, "bwtDossiers", "dossier"):
-                    (count, total_count) = add_pre_wabo_dossier(
-                        x_dossier, file_path, import_file, count, total_count, meta_ids
-                    )
+    if source is None:
+        source = FileSource(root_dir)
+    if counters is None:
+        counters = ImportCounters()
 
-            import_file.status = const.IMPORT_FINISHED
-            import_file.save()
-            file_count += 1
-            if max_file_count and file_count >= max_file_count:
-                break
+    meta_ids = _get_meta_additions(root_dir, source)
 
-        except Exception as e:
-            log.error(f"Error while processing file {file_path} : {e}")
-            import_file.status = const.IMPORT_ERROR
-            import_file.save()
+    if file_paths is None:
+        _, file_paths = scan_dossier_files(root_dir, source)
 
-        log.info(f"Import in process. Imported files: {file_count}. Imported dossiers: {total_count}")
+    if max_file_count:
+        file_paths = file_paths[:max_file_count]
+
+    if workers > 1:
+        file_count, total_count = _import_files_parallel(
+            file_paths, add_pre_wabo_dossier, meta_ids, workers, batch_size, writer, source, counters
+        )
+    else:
+        dossier_keys = DossierKeys.from_db()
+        for file_path in file_paths:
+            count = import_dossier_file(
+                file_path,
+                add_pre_wabo_dossier,
+                meta_ids,
+                total_count,
+                batch_size,
+                writer,
+                dossier_keys,
+                source=source,
+                counters=counters,
+            )
+            if count is not None:
+                total_count += count
+                file_count += 1
+
+            log.info(f"Import in process. Imported files: {file_count}. Imported dossiers: {total_count}")
 
     log.info(f"Import finished. Bouwdossiers total: {total_count}")
 
 
-def add_bag_ids_to_wabo():
-    # This gets the nummeraanduidingen using the verblijfsobjecten instead of using the
-    # address as it is done in the pre-wabo dossiers.
-    log.info("Add nummeraanduidingen to wabo dossiers")
-    with connection.cursor() as cursor:
-        try:
-            cursor.execute(
-                """
+# This gets the nummeraanduidingen using the verblijfsobjecten instead of using the
+# address as it is done in the pre-wabo dossiers. The query returns the number of updated
+# adressen and the number of those that had no nummeraanduidingen before.
+WABO_BAG_IDS_QUERY = """
 WITH adres_nummeraanduiding AS (
     SELECT
         ba.id AS id,
-        ARRAY_AGG(bag_nra.identificatie) AS nummeraanduidingen,
-        ARRAY_AGG(bag_opr.naam || ' ' || bag_nra.huisnummer ||
-            CASE WHEN (bag_nra.huisletter = '') IS NOT FALSE THEN '' ELSE bag_nra.huisletter END ||
-            CASE WHEN (bag_nra.huisnummertoevoeging = '') IS NOT FALSE THEN '' ELSE '-' || bag_nra.huisnummertoevoeging
-            END) AS nummeraanduidingen_label
+        ARRAY_AGG(lookup.nummeraanduiding_id) AS nummeraanduidingen,
+        ARRAY_AGG(lookup.label) AS nummeraanduidingen_label,
+        COALESCE(ARRAY_LENGTH(ba.nummeraanduidingen, 1), 0) = 0 AS nummeraanduidingen_added
     FROM importer_adres ba
     JOIN importer_bouwdossier bb ON bb.id = ba.bouwdossier_id
-    JOIN bag_nummeraanduiding bag_nra ON bag_nra.adresseertverblijfsobjectid = ANY(ba.verblijfsobjecten)
-    JOIN bag_openbareruimte bag_opr ON bag_opr.identificatie = bag_nra.ligtaanopenbareruimteid
+    JOIN bag_adres_lookup lookup ON lookup.verblijfsobject_id = ANY(ba.verblijfsobjecten)
     WHERE bb.source = 'WABO'
-    GROUP BY ba.id)
-UPDATE importer_adres
-SET nummeraanduidingen = adres_nummeraanduiding.nummeraanduidingen,
-nummeraanduidingen_label = adres_nummeraanduiding.nummeraanduidingen_label
-FROM adres_nummeraanduiding
-WHERE importer_adres.id = adres_nummeraanduiding.id
-            """
+    GROUP BY ba.id),
+updated AS (
+    UPDATE importer_adres
+    SET nummeraanduidingen = adres_nummeraanduiding.nummeraanduidingen,
+    nummeraanduidingen_label = adres_nummeraanduiding.nummeraanduidingen_label
+    FROM adres_nummeraanduiding
+    WHERE importer_adres.id = adres_nummeraanduiding.id
+    RETURNING adres_nummeraanduiding.nummeraanduidingen_added
+)
+SELECT COUNT(*), COUNT(*) FILTER (WHERE nummeraanduidingen_added) FROM updated
+"""
+
+
+def add_bag_ids_to_wabo(counters=None):
+    """
+    The adressen that get their first nummeraanduidingen are added to `counters`
+    """
+    log.info("Add nummeraanduidingen to wabo dossiers")
+    with connection.cursor() as cursor:
+        try:
+            log_query_plan(cursor, "the WABO matching", WABO_BAG_IDS_QUERY)
+            started = time.perf_counter()
+            cursor.execute(WABO_BAG_IDS_QUERY)
+            updated_count, nummeraanduidingen_added = cursor.fetchone()
+            if counters is not None:
+                counters.add(const.SOURCE_WABO, "has_nummeraanduidingen", nummeraanduidingen_added)
+            log.info(
+                f"Added nummeraanduidingen to {updated_count} wabo adressen in {time.perf_counter() - started:.1f}s"
             )
         except Exception:
             log.exception("An error occurred while adding the nummeraanduidingen.")
     log.info("Finished adding nummeraanduidingen to wabo dossiers")
 
 
-def add_bag_ids_to_pre_wabo():
+# In the importer_adres the adresses are given as a range
+# from huisnummer_van till huisnummer_tot
+# We want to include all nummeraanduidingen, verblijfsobjecten and panden in range
+# However, often  we can only use the even or odd number in the range when opposite
+# sides of the street use even resp odd numbers. But sometimes we have to use all the
+# numbers in the range. Therefore we use bouwblokken to select all numbers in the range
+# that also are in the same bouwblok as the start or the end of the range.
+# Every address is matched on its own, so the query can be run for a range of
+# importer_adres ids at a time. The addresses come from the bag_adres_pand_lookup view,
+# which has a row per nummeraanduiding and pand with the bouwblok and the label.
+# The query returns the number of updated adressen and how many of them had no panden
+# and no nummeraanduidingen before.
+PRE_WABO_BAG_IDS_QUERY = """
+WITH adres_start_end_bouwblok AS (
+    SELECT iadre.id, ARRAY_AGG(DISTINCT lookup.bouwblok) AS bouwblokken
+    FROM importer_adres iadre
+    JOIN bag_adres_pand_lookup lookup
+        ON lookup.straat = iadre.straat
+        AND (lookup.huisnummer = iadre.huisnummer_van
+            OR lookup.huisnummer = iadre.huisnummer_tot)
+        AND lookup.nummeraanduiding_id LIKE '0363%%' -- Only match Amsterdam addresses
+    JOIN importer_bouwdossier ibouw ON ibouw.id = iadre.bouwdossier_id
+    WHERE ibouw.source = 'EDEPOT'
+        AND iadre.id BETWEEN %(first_id)s AND %(last_id)s
+    GROUP BY iadre.id
+),
+adres_pand AS (
+    SELECT
+        iadre.id,
+        -- Then we  select all verblijfsobjecten and nummeraanduidingen in the range
+        -- that also are in the same bouwblok as the start or end
+        ARRAY_AGG(DISTINCT lookup.pand_id) AS panden,
+        ARRAY_AGG(DISTINCT lookup.verblijfsobject_id) AS verblijfsobjecten,
+        ARRAY_AGG(DISTINCT lookup.label) AS verblijfsobjecten_label,
+        ARRAY_AGG(DISTINCT lookup.nummeraanduiding_id) AS nummeraanduidingen,
+        ARRAY_AGG(DISTINCT lookup.label) AS nummeraanduidingen_label,
+        COALESCE(ARRAY_LENGTH(iadre.panden, 1), 0) = 0 AS panden_added,
+        COALESCE(ARRAY_LENGTH(iadre.nummeraanduidingen, 1), 0) = 0 AS nummeraanduidingen_added
+    FROM importer_adres iadre
+    JOIN bag_adres_pand_lookup lookup
+        ON lookup.straat = iadre.straat
+        AND iadre.huisnummers @> lookup.huisnummer
+        AND iadre.huisnummer_tot IS NOT NULL -- huisnummers also covers an adres without huisnummer_tot
+        AND lookup.nummeraanduiding_id LIKE '0363%%' -- Only match Amsterdam addresses
+    JOIN importer_bouwdossier ibouw ON ibouw.id = iadre.bouwdossier_id
+    JOIN adres_start_end_bouwblok aseb ON aseb.id = iadre.id
+    WHERE ibouw.source = 'EDEPOT'
+        AND iadre.id BETWEEN %(first_id)s AND %(last_id)s
+        AND lookup.bouwblok = ANY(aseb.bouwblokken)
+    GROUP BY iadre.id
+),
+updated AS (
+    UPDATE importer_adres
+    SET panden = adres_pand.panden,
+        verblijfsobjecten = adres_pand.verblijfsobjecten,
+        verblijfsobjecten_label = adres_pand.verblijfsobjecten_label,
+        nummeraanduidingen = adres_pand.nummeraanduidingen,
+        nummeraanduidingen_label = adres_pand.nummeraanduidingen_label
+    FROM adres_pand
+    WHERE importer_adres.id = adres_pand.id
+    RETURNING adres_pand.panden_added, adres_pand.nummeraanduidingen_added
+)
+SELECT COUNT(*), COUNT(*) FILTER (WHERE panden_added), COUNT(*) FILTER (WHERE nummeraanduidingen_added)
+FROM updated
+"""
+
+
+def _get_id_partitions(table, partition_count):
+    """
+    Split the ids of a table into `partition_count` consecutive (first_id, last_id) ranges
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT MIN(id), MAX(id) FROM {table}")
+        first_id, last_id = cursor.fetchone()
+    if first_id is None:
+        return []
+
+    size = -(-(last_id - first_id + 1) // partition_count)
+    return [(start, min(start + size - 1, last_id)) for start in range(first_id, last_id + 1, size)]
+
+
+def _add_bag_ids_to_pre_wabo_partition(first_id, last_id):
+    with connection.cursor() as cursor:
+        cursor.execute(PRE_WABO_BAG_IDS_QUERY, {"first_id": first_id, "last_id": last_id})
+        return cursor.fetchone()
+
+
+def _add_bag_ids_to_pre_wabo_thread(first_id, last_id):
+    # Every thread gets its own database connection, which is closed when the thread is done
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SET max_parallel_workers_per_gather = 0")
+        return _add_bag_ids_to_pre_wabo_partition(first_id, last_id)
+    finally:
+        connection.close()
+
+
+def add_bag_ids_to_pre_wabo(workers=1, counters=None):
     """
     This will try to add bag ids to addresses by matching streetname and house number.
     Currently all addresses in XML files are in Amsterdam. No residence is given in the XML file.
     Because Weesp is added to the bag we only use addresses in Amsterdam by
     adding the  *.id LIKE '0363%' clause.
+
+    With more than one worker the addresses are split in ranges of ids that are matched
+    concurrently, each on its own database connection. The adressen that get their first
+    panden, nummeraanduidingen or openbare ruimte are added to `counters`.
     """
+    if counters is None:
+        counters = ImportCounters()
+
     # TODO check if there realy aren't Weesp adressen??
     log.info("Add nummeraanduidingen,verblijfsobjecten and panden to pre-wabo dossiers")
     with connection.cursor() as cursor:
@@ -678,179 +1488,107 @@ def add_bag_ids_to_pre_wabo():
         # parallel query can fail due to lack of /dev/shm shared memory
         cursor.execute("SET max_parallel_workers_per_gather = 0")
 
-        # In the importer_adres the adresses are given as a range
-        # from huisnummer_van till huisnummer_tot
-        # We want to include all nummeraanduidingen, verblijfsobjecten and panden in range
-        # However, often  we can only use the even or odd number in the range when opposite
-        # sides of the street use even resp odd numbers. But sometimes we have to use all the
-        # numbers in the range. Therefore we use bouwblokken to select all numbers in the range
-        # that also are in the same bouwblok as the start or the end of the range
-        cursor.execute(
-            """
-WITH adres_start_end_bouwblok AS (
-	SELECT iadre.id, ARRAY_AGG(DISTINCT bpand.ligtinbouwblokid) AS bouwblokken
-		FROM importer_adres iadre
-		JOIN bag_openbareruimte bopen ON bopen.naam = iadre.straat
-		join bag_nummeraanduiding bnumm
-			on bnumm.ligtaanopenbareruimteid = bopen.identificatie 
-			and (bnumm.huisnummer = iadre.huisnummer_van 
-		        or bnumm.huisnummer = iadre.huisnummer_tot)
-			and bnumm.identificatie like '0363%' -- Only match Amsterdam addresses
-		join bag_verblijfsobject bver on bver.identificatie = bnumm.adresseertverblijfsobjectid 
-		join bag_verblijfsobjectpandrelatie bvpr on bvpr.verblijfsobjectenidentificatie = bver.identificatie
-		join bag_pand bpand on bpand.identificatie = bvpr.ligtinpandenidentificatie
-		JOIN importer_bouwdossier ibouw ON ibouw.id = iadre.bouwdossier_id
-		where ibouw.source = 'EDEPOT'
-		group by iadre.id
-),
-adres_pand AS (
-    SELECT
-	    iadre.id,
-	    -- Then we  select all verblijfsobjecten and nummeraanduidingen in the range
-        -- that also are in the same bouwblok as the start or end
-        ARRAY_AGG(DISTINCT bpand.identificatie) AS panden,
-        ARRAY_AGG(DISTINCT bverb.identificatie) AS verblijfsobjecten,
-        ARRAY_AGG(DISTINCT bopen.naam || ' ' || bnumm.huisnummer || 
-            CASE WHEN (bnumm.huisletter = '') IS NOT FALSE THEN '' ELSE bnumm.huisletter END ||
-            CASE WHEN (bnumm.huisnummertoevoeging = '') IS NOT FALSE THEN '' ELSE '-' || bnumm.huisnummertoevoeging
-            END) AS verblijfsobjecten_label,
-        ARRAY_AGG(DISTINCT bnumm.identificatie) AS nummeraanduidingen,
-        ARRAY_AGG(DISTINCT bopen.naam || ' ' || bnumm.huisnummer || 
-            CASE WHEN (bnumm.huisletter = '') IS NOT FALSE THEN '' ELSE bnumm.huisletter END ||
-            CASE WHEN (bnumm.huisnummertoevoeging = '') IS NOT FALSE THEN '' ELSE '-' || bnumm.huisnummertoevoeging
-            END) AS nummeraanduidingen_label
-	FROM importer_adres iadre
-	JOIN bag_openbareruimte bopen ON bopen.naam = iadre.straat
-	join bag_nummeraanduiding bnumm
-		on bnumm.ligtaanopenbareruimteid = bopen.identificatie 
-		and (bnumm.huisnummer >= iadre.huisnummer_van 
-		    and bnumm.huisnummer <= iadre.huisnummer_tot)
-		and bnumm.identificatie like '0363%' -- Only match Amsterdam addresses
-	join bag_verblijfsobject bverb on bverb.identificatie = bnumm.adresseertverblijfsobjectid 
-	join bag_verblijfsobjectpandrelatie bvpr on bvpr.verblijfsobjectenidentificatie = bverb.identificatie
-	join bag_pand bpand on bpand.identificatie = bvpr.ligtinpandenidentificatie
-	JOIN importer_bouwdossier ibouw ON ibouw.id = iadre.bouwdossier_id
-	JOIN adres_start_end_bouwblok aseb ON aseb.id = iadre.id
-    WHERE ibouw.source = 'EDEPOT'
-    	AND bpand.ligtinbouwblokid=ANY(aseb.bouwblokken)
-    GROUP BY iadre.id
-)
-UPDATE importer_adres
-SET panden = adres_pand.panden,
-    verblijfsobjecten = adres_pand.verblijfsobjecten,
-    verblijfsobjecten_label = adres_pand.verblijfsobjecten_label,
-    nummeraanduidingen = adres_pand.nummeraanduidingen,
-    nummeraanduidingen_label = adres_pand.nummeraanduidingen_label
-FROM adres_pand
-WHERE importer_adres.id = adres_pand.id
-        """
-        )
-    log.info("Finished adding nummeraanduidingen, verblijfsobjecten and panden to pre-wabo dossiers")
+    # More partitions than workers, so a slow partition does not hold up the whole phase
+    partitions = _get_id_partitions(models.Adres._meta.db_table, workers * 4 if workers > 1 else 1)
+    if partitions:
+        first_id, last_id = partitions[0]
+        with connection.cursor() as cursor:
+            log_query_plan(
+                cursor,
+                f"the pre-WABO matching of adres ids {first_id}-{last_id}",
+                PRE_WABO_BAG_IDS_QUERY,
+                {"first_id": first_id, "last_id": last_id},
+            )
 
-    # First we try to match with openbare ruimtes that are streets 01
-    log.info("Add openbare ruimtes")
-    with connection.cursor() as cursor:
-        cursor.execute(
-            """
-UPDATE importer_adres iadre
-SET openbareruimte_id = bopen.identificatie
-FROM bag_openbareruimte bopen
-WHERE iadre.straat = bopen.naam
-AND (bopen.eindgeldigheid is NULL 
-		OR bopen.eindgeldigheid >= NOW())
-	AND bopen.typecode = '1'
-	AND bopen.identificatie like '0363%' -- Only match Amsterdam streets
-        """
-        )
+    started = time.perf_counter()
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_add_bag_ids_to_pre_wabo_thread, first_id, last_id): (first_id, last_id)
+                for first_id, last_id in partitions
+            }
+            for done_count, future in enumerate(as_completed(futures), 1):
+                first_id, last_id = futures[future]
+                updated_count, panden_added, nummeraanduidingen_added = future.result()
+                counters.add(const.SOURCE_EDEPOT, "has_panden", panden_added)
+                counters.add(const.SOURCE_EDEPOT, "has_nummeraanduidingen", nummeraanduidingen_added)
+                log.info(
+                    f"Matched partition {done_count}/{len(partitions)} with adres ids {first_id}-{last_id}: "
+                    f"{updated_count} adressen updated"
+                )
+    else:
+        for first_id, last_id in partitions:
+            _, panden_added, nummeraanduidingen_added = _add_bag_ids_to_pre_wabo_partition(first_id, last_id)
+            counters.add(const.SOURCE_EDEPOT, "has_panden", panden_added)
+            counters.add(const.SOURCE_EDEPOT, "has_nummeraanduidingen", nummeraanduidingen_added)
+    log.info(
+        "Finished adding nummeraanduidingen, verblijfsobjecten and panden to pre-wabo dossiers "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
 
-    # If the openbareruimte was not yet found we try to match with other openbare ruimtes
+    log.info("Add openbare ruimtes")
     with connection.cursor() as cursor:
-        cursor.execute(
-            """
-UPDATE importer_adres iadre
-SET openbareruimte_id = bopen.identificatie
-FROM bag_openbareruimte bopen
-WHERE iadre.straat = bopen.naam
-AND bopen.identificatie LIKE '0363%'  -- Only match Amsterdam streets
-AND (iadre.openbareruimte_id IS NULL OR iadre.openbareruimte_id = '')
-        """
-        )
+        log_query_plan(cursor, "the openbare ruimte matching", OPENBARERUIMTE_QUERY)
+        started = time.perf_counter()
+        cursor.execute(OPENBARERUIMTE_QUERY)
+        updated_count = 0
+        for source, source_updated_count, openbareruimte_added in cursor.fetchall():
+            updated_count += source_updated_count
+            counters.add(source, "has_openbareruimte_id", openbareruimte_added)
+        log.info(f"Updated the openbare ruimte of {updated_count} adressen in {time.perf_counter() - started:.1f}s")
     log.info("Finished adding openbare ruimtes")
 
 
-def validate_import(min_bouwdossiers_count):
-    result = models.Adres.objects.aggregate(
-        total=Count("id"),
-        has_panden=Sum(Case(When(panden__len__gt=0, then=1), default=0, output_field=IntegerField())),
-        has_nummeraanduidingen=Sum(
-            Case(
-                When(nummeraanduidingen__len__gt=0, then=1),
-                default=0,
-                output_field=IntegerField(),
-            )
-        ),
-        has_openbareruimte_id=Sum(
-            Case(
-                When(
-                    ~Q(openbareruimte_id__isnull=True) & ~Q(openbareruimte_id=""),
-                    then=1,
-                ),
-                default=0,
-                output_field=IntegerField(),
-            )
-        ),
-        wabo_total=Count("id", filter=Q(bouwdossier__source=const.SOURCE_WABO)),
-        wabo_bwt=Count("id", filter=Q(bouwdossier__wabo_bron="BWT")),
-        wabo_has_panden=Sum(
-            Case(When(panden__len__gt=0, then=1), default=0, output_field=IntegerField()),
-            filter=Q(bouwdossier__source=const.SOURCE_WABO),
-        ),
-        wabo_has_nummeraanduidingen=Sum(
-            Case(
-                When(nummeraanduidingen__len__gt=0, then=1),
-                default=0,
-                output_field=IntegerField(),
-            ),
-            filter=Q(bouwdossier__source=const.SOURCE_WABO),
-        ),
-        wabo_has_openbareruimte_id=Sum(
-            Case(
-                When(
-                    ~Q(openbareruimte_id__isnull=True) & ~Q(openbareruimte_id=""),
-                    then=1,
-                ),
-                default=0,
-                output_field=IntegerField(),
-            ),
-            filter=Q(bouwdossier__source=const.SOURCE_WABO),
-        ),
-        prewabo_total=Count("id", filter=Q(bouwdossier__source=const.SOURCE_EDEPOT)),
-        prewabo_has_panden=Sum(
-            Case(When(panden__len__gt=0, then=1), default=0, output_field=IntegerField()),
-            filter=Q(bouwdossier__source=const.SOURCE_EDEPOT),
-        ),
-        prewabo_has_nummeraanduidingen=Sum(
-            Case(
-                When(nummeraanduidingen__len__gt=0, then=1),
-                default=0,
-                output_field=IntegerField(),
-            ),
-            filter=Q(bouwdossier__source=const.SOURCE_EDEPOT),
-        ),
-        prewabo_has_openbareruimte_id=Sum(
-            Case(
-                When(
-                    ~Q(openbareruimte_id__isnull=True) & ~Q(openbareruimte_id=""),
-                    then=1,
-                ),
-                default=0,
-                output_field=IntegerField(),
-            ),
-            filter=Q(bouwdossier__source=const.SOURCE_EDEPOT),
-        ),
-    )
+# Streets (typecode 01) that are still valid are preferred, the adres gets one of them when the
+# name matches. Otherwise an adres without openbareruimte gets any openbare ruimte with the name.
+# One openbare ruimte is picked per name, so every adres is written at most once.
+# The query returns per source the number of updated adressen and the number of those
+# that had no openbare ruimte before.
+OPENBARERUIMTE_QUERY = """
+WITH openbareruimte_per_naam AS (
+    SELECT DISTINCT ON (bopen.naam)
+        bopen.naam,
+        bopen.identificatie,
+        (bopen.eindgeldigheid IS NULL OR bopen.eindgeldigheid >= NOW()) AND bopen.typecode = '1' AS preferred
+    FROM bag_openbareruimte bopen
+    WHERE bopen.identificatie LIKE '0363%' -- Only match Amsterdam streets
+    ORDER BY bopen.naam, preferred DESC, bopen.identificatie
+),
+adres_openbareruimte AS (
+    SELECT
+        iadre.id,
+        opn.identificatie,
+        ibouw.source,
+        iadre.openbareruimte_id IS NULL OR iadre.openbareruimte_id = '' AS openbareruimte_added
+    FROM importer_adres iadre
+    JOIN openbareruimte_per_naam opn ON opn.naam = iadre.straat
+    JOIN importer_bouwdossier ibouw ON ibouw.id = iadre.bouwdossier_id
+    WHERE (opn.preferred OR iadre.openbareruimte_id IS NULL OR iadre.openbareruimte_id = '')
+        AND iadre.openbareruimte_id IS DISTINCT FROM opn.identificatie
+),
+updated AS (
+    UPDATE importer_adres
+    SET openbareruimte_id = adres_openbareruimte.identificatie
+    FROM adres_openbareruimte
+    WHERE importer_adres.id = adres_openbareruimte.id
+    RETURNING adres_openbareruimte.source, adres_openbareruimte.openbareruimte_added
+)
+SELECT source, COUNT(*), COUNT(*) FILTER (WHERE openbareruimte_added)
+FROM updated
+GROUP BY source
+"""
+
+
+def validate_import(min_bouwdossiers_count, counters=None):
+    """
+    Check the numbers of imported and matched adressen. They are taken from the `counters`
+    that were kept during the import, or counted in the importer tables when not given.
+    """
+    if counters is None:
+        counters = ImportCounters.from_db()
+    result = counters.as_result()
 
-    log.info("Validation import result: " + str(result))
+    log.info("Validation import result: " + str(result), extra={"metrics": result})
 
     log.info(
         f"{result['has_panden']} number of records of a total of {result['total']} records"
@@ -1,21 +1,34 @@
 import logging
+from contextlib import nullcontext
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from opentelemetry import trace
 
 from importer.batch import (
+    DOSSIER_WRITERS,
+    BlobSource,
+    FileSource,
+    ImportCounters,
     add_bag_ids_to_pre_wabo,
     add_bag_ids_to_wabo,
+    copy_unchanged_files,
     import_pre_wabo_dossiers,
     import_wabo_dossiers,
+    is_import_unfinished,
+    reset_unfinished_files,
+    scan_dossier_files,
+    set_import_unfinished,
     validate_import,
 )
-from importer.util_azure import (
-    download_all_files_from_container,
-    remove_directory,
+from importer.util_azure import sync_container_to_directory
+from importer.util_db import (
+    analyze_tables,
+    bulk_load,
+    restore_bulk_loaded_tables,
+    swap_tables_between_apps,
+    truncate_tables,
 )
-from importer.util_db import swap_tables_between_apps, truncate_tables
 
 tracer = trace.get_tracer(__name__)
 
@@ -25,14 +38,50 @@ log = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = "Import (pre)WABO dossiers and combine with BAG data from datadienst export"
 
-    def import_dossiers(self, dossier_path):
+    def import_dossiers(
+        self,
+        dossier_path,
+        workers=1,
+        batch_size=settings.IMPORT_BATCH_SIZE,
+        writer=settings.IMPORT_WRITER,
+        match_workers=settings.IMPORT_MATCH_WORKERS,
+        source=None,
+        counters=None,
+    ):
+        wabo_file_paths, pre_wabo_file_paths = scan_dossier_files(dossier_path, source)
+
         log.info("Importing pre wabo dossiers")
-        import_pre_wabo_dossiers(dossier_path)
-        add_bag_ids_to_pre_wabo()
+        with tracer.start_as_current_span("Load pre-WABO dossiers"):
+            import_pre_wabo_dossiers(
+                dossier_path,
+                workers=workers,
+                batch_size=batch_size,
+                writer=writer,
+                file_paths=pre_wabo_file_paths,
+                source=source,
+                counters=counters,
+            )
+        # The matching queries are planned with the statistics of the loaded tables
+        with tracer.start_as_current_span("Analyze importer tables"):
+            analyze_tables("importer")
+        with tracer.start_as_current_span("Match pre-WABO adressen"):
+            add_bag_ids_to_pre_wabo(workers=match_workers, counters=counters)
 
         log.info("Importing wabo dossiers")
-        import_wabo_dossiers(dossier_path)
-        add_bag_ids_to_wabo()
+        with tracer.start_as_current_span("Load WABO dossiers"):
+            import_wabo_dossiers(
+                dossier_path,
+                workers=workers,
+                batch_size=batch_size,
+                writer=writer,
+                file_paths=wabo_file_paths,
+                source=source,
+                counters=counters,
+            )
+        with tracer.start_as_current_span("Analyze importer tables"):
+            analyze_tables("importer")
+        with tracer.start_as_current_span("Match WABO adressen"):
+            add_bag_ids_to_wabo(counters=counters)
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -51,6 +100,80 @@ class Command(BaseCommand):
             help="Minimum amount of bouwdossiers to be added",
         )
 
+        parser.add_argument(
+            "--workers",
+            dest="workers",
+            type=int,
+            default=settings.IMPORT_WORKERS,
+            help="Number of worker processes importing the dossier files in parallel",
+        )
+
+        parser.add_argument(
+            "--batch_size",
+            dest="batch_size",
+            type=int,
+            default=settings.IMPORT_BATCH_SIZE,
+            help="Number of bouwdossiers written to the database with one bulk insert",
+        )
+
+        parser.add_argument(
+            "--writer",
+            dest="writer",
+            choices=sorted(DOSSIER_WRITERS),
+            default=settings.IMPORT_WRITER,
+            help="Write the dossiers with ORM bulk inserts (orm) or with COPY FROM STDIN (copy)",
+        )
+
+        parser.add_argument(
+            "--match_workers",
+            dest="match_workers",
+            type=int,
+            default=settings.IMPORT_MATCH_WORKERS,
+            help="Number of database connections matching the pre-WABO adressen with the BAG in parallel",
+        )
+
+        parser.add_argument(
+            "--source",
+            dest="source",
+            choices=["files", "blob"],
+            default=settings.IMPORT_SOURCE,
+            help="Download the dossier files before importing them (files) or stream them from the blob storage (blob)",
+        )
+
+        parser.add_argument(
+            "--download_workers",
+            dest="download_workers",
+            type=int,
+            default=settings.AZURE_DOWNLOAD_WORKERS,
+            help="Number of dossier files downloaded from the blob storage at the same time",
+        )
+
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            dest="incremental",
+            default=False,
+            help="Only import new and changed files, copy the dossiers of unchanged pre-WABO files from the "
+            "previous import",
+        )
+
+        parser.add_argument(
+            "--bulk_load",
+            action="store_true",
+            dest="bulk_load",
+            default=settings.IMPORT_BULK_LOAD,
+            help="Load the importer tables unlogged and without secondary indexes, the indexes are built "
+            "afterwards using match_workers connections",
+        )
+
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            dest="resume",
+            default=False,
+            help="Continue an interrupted import: keep the files that were imported and import the remaining files",
+        )
+
     def handle(self, *args, **options):
         with tracer.start_as_current_span("Import (pre)WABO") as span:
             self._handle(*args, **options)
@@ -60,16 +183,59 @@ class Command(BaseCommand):
 
         try:
             dossier_path = settings.DATA_DIR
-            if not options["skipgetfiles"]:
+            if options["source"] == "blob":
+                # The files are named as if they were downloaded, so resume and incremental imports
+                # work the same for both sources
                 dossier_path = f"{settings.DATA_DIR}/dossiers"
-                remove_directory(dossier_path)
-                download_all_files_from_container(settings.AZURE_CONTAINER_NAME_DOSSIERS, dossier_path)
-
-            truncate_tables(["importer"])
-            self.import_dossiers(dossier_path)
-
-            validate_import(options["min_bouwdossiers_count"])
-
+                source = BlobSource(settings.AZURE_CONTAINER_NAME_DOSSIERS, dossier_path)
+            else:
+                if not options["skipgetfiles"]:
+                    dossier_path = f"{settings.DATA_DIR}/dossiers"
+                    sync_container_to_directory(
+                        settings.AZURE_CONTAINER_NAME_DOSSIERS, dossier_path, workers=options["download_workers"]
+                    )
+                source = FileSource(dossier_path)
+
+            resume = options["resume"]
+            if resume and not is_import_unfinished():
+                # After a swap the importer tables hold the previous import, which must not be resumed
+                log.warning("The importer tables do not hold an unfinished import, starting a full import")
+                resume = False
+
+            if resume:
+                reset_unfinished_files()
+            else:
+                truncate_tables(["importer"])
+                set_import_unfinished(True)
+
+            load = bulk_load("importer", options["match_workers"]) if options["bulk_load"] else nullcontext()
+            with load:
+                if options["incremental"] and not resume:
+                    copy_unchanged_files(dossier_path, source)
+                # The counters start from the adressen that are already there, the copied ones or
+                # the ones imported before the import was resumed
+                counters = ImportCounters.from_db()
+                self.import_dossiers(
+                    dossier_path,
+                    workers=options["workers"],
+                    batch_size=options["batch_size"],
+                    writer=options["writer"],
+                    match_workers=options["match_workers"],
+                    source=source,
+                    counters=counters,
+                )
+            # A bulk load of a run that was killed can have left the tables unlogged and unindexed
+            restore_bulk_loaded_tables("importer", options["match_workers"])
+            # The statistics go along with the tables when they are swapped, so the API does not
+            # start on the statistics of the previous import
+            with tracer.start_as_current_span("Analyze importer tables"):
+                analyze_tables("importer")
+
+            span = trace.get_current_span()
+            span.set_attributes({f"import.{key}": value for key, value in counters.as_result().items()})
+            validate_import(options["min_bouwdossiers_count"], counters)
+
+            set_import_unfinished(False)
             swap_tables_between_apps("importer", "bouwdossiers")
 
         except Exception as e:
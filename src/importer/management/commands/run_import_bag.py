@@ -1,11 +1,12 @@
 import logging
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from opentelemetry import trace
 
 from bag import bag_api
-from bag.bag_controller import BagController
+from bag.bag_controller import BAG_WRITERS, BagController
 from bag.models import BagUpdatedAt, Verblijfsobjectpandrelatie
 
 tracer = trace.get_tracer(__name__)
@@ -20,18 +21,42 @@ class Command(BaseCommand):
         with tracer.start_as_current_span("Import BAG") as span:
             self._handle(*args, **options)
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--download_workers",
+            type=int,
+            dest="download_workers",
+            default=settings.BAG_DOWNLOAD_WORKERS,
+            help="Number of BAG dumps that are downloaded at the same time",
+        )
+        parser.add_argument(
+            "--writer",
+            dest="writer",
+            choices=BAG_WRITERS,
+            default=settings.BAG_WRITER,
+            help="How the BAG records are upserted: bulk_create (orm) or COPY into a staging table (copy)",
+        )
+
     def _handle(self, *args, **options):
+        bag_zip_api = None
         try:
+            bag_zip_api = bag_api.Zip()
+            # The dumps are downloaded in the background while the models are imported in order
+            bag_zip_api.prefetch(options["download_workers"])
+
             with transaction.atomic():
-                bag_zip_api = bag_api.Zip()
-                bag = BagController()
+                bag = BagController(writer=options["writer"])
 
                 upserted_model_keys = {}
                 for bag_model in bag_zip_api.model_to_endpoint.keys():
-                    if isinstance(bag_model, Verblijfsobjectpandrelatie):
+                    if bag_model is Verblijfsobjectpandrelatie:
                         continue
 
                     records = bag_zip_api.get_records(bag_model)
+                    # The records of an unchanged dump are in the database already
+                    if bag_zip_api.is_unchanged(bag_model):
+                        logger.info(f"The {bag_model.__name__} dump is unchanged, skipping it")
+                        continue
                     upserted_model_keys[bag_model] = list(bag.upsert_records_in_database(bag_model, records))
 
                 # Reversed order because of foreign key dependencies
@@ -41,26 +66,39 @@ class Command(BaseCommand):
 
                 # Process the Verblijfsobjectpandrelatie junction table separately after all other objects are processed first
                 records = bag_zip_api.get_records(Verblijfsobjectpandrelatie)
-                records = bag.filter_valid_references(
-                    # Threshold (100) 06-12-24 tijdelijk hoog gezet want rijtjeshuizen berekening staat uit, bag import belangrijker
-                    Verblijfsobjectpandrelatie,
-                    records,
-                    threshold=100,
-                )
-                upserted_model_keys_verblijfsobjectpandrelatie = list(
-                    bag.upsert_records_in_database(Verblijfsobjectpandrelatie, records)
-                )
-                bag.delete_nonmodified_table_records(
-                    Verblijfsobjectpandrelatie,
-                    upserted_model_keys_verblijfsobjectpandrelatie,
-                )
+                if bag_zip_api.is_unchanged(Verblijfsobjectpandrelatie):
+                    logger.info("The Verblijfsobjectpandrelatie dump is unchanged, skipping it")
+                else:
+                    records = bag.filter_valid_references(
+                        # Threshold (100) 06-12-24 tijdelijk hoog gezet want rijtjeshuizen berekening staat uit, bag import belangrijker
+                        Verblijfsobjectpandrelatie,
+                        records,
+                        threshold=100,
+                    )
+                    upserted_model_keys_verblijfsobjectpandrelatie = list(
+                        bag.upsert_records_in_database(Verblijfsobjectpandrelatie, records)
+                    )
+                    bag.delete_nonmodified_table_records(
+                        Verblijfsobjectpandrelatie,
+                        upserted_model_keys_verblijfsobjectpandrelatie,
+                    )
+
+                # The dossier matching uses the flattened addresses
+                if len(bag_zip_api.unchanged_endpoints) < len(bag_zip_api.model_to_endpoint):
+                    bag.refresh_adres_lookup()
 
                 # save timestamp separately in db
                 BagUpdatedAt().save()
 
+            # Only now the downloaded dumps are in the database, so they can be skipped next time
+            bag_zip_api.save_manifest()
+
             logger.info(f"Bag import succeeded, updated_at {BagUpdatedAt.objects.last().updated_at}")
 
         except Exception as e:
             logger.exception(
                 f"An exception occurred importing the BAG. All operations aborted, database rolled back. Error: {e}"
             )
+        finally:
+            if bag_zip_api is not None:
+                bag_zip_api.shutdown()
@@ -0,0 +1,22 @@
+# Generated by Django 6.0.2 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("importer", "0003_alter_document_document_omschrijving"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="importfile",
+            name="content_hash",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="importfile",
+            name="size",
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
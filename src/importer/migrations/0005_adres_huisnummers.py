@@ -0,0 +1,53 @@
+# Generated by Django 6.0.2 on 2026-10-18 10:41
+
+import django.contrib.postgres.fields.ranges
+import django.contrib.postgres.indexes
+import django.db.models.functions.comparison
+from django.contrib.postgres.operations import BtreeGistExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("importer", "0004_importfile_content_hash_importfile_size"),
+    ]
+
+    operations = [
+        # Needed for the straat column in the GiST index
+        BtreeGistExtension(),
+        migrations.AddField(
+            model_name="adres",
+            name="huisnummers",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=models.Case(
+                    models.When(huisnummer_van__isnull=True, then=None),
+                    models.When(
+                        huisnummer_tot__lt=models.F("huisnummer_van"),
+                        then=models.Func(
+                            models.Value(0),
+                            models.Value(0),
+                            function="int4range",
+                            output_field=django.contrib.postgres.fields.ranges.IntegerRangeField(),
+                        ),
+                    ),
+                    default=models.Func(
+                        models.F("huisnummer_van"),
+                        django.db.models.functions.comparison.Coalesce(
+                            models.F("huisnummer_tot"), models.F("huisnummer_van")
+                        ),
+                        models.Value("[]"),
+                        function="int4range",
+                        output_field=django.contrib.postgres.fields.ranges.IntegerRangeField(),
+                    ),
+                ),
+                output_field=django.contrib.postgres.fields.ranges.IntegerRangeField(),
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="adres",
+            index=django.contrib.postgres.indexes.GistIndex(
+                fields=["straat", "huisnummers"], name="importer_ad_straat_642626_gist"
+            ),
+        ),
+    ]
@@ -1,11 +1,33 @@
+import glob
+import io
+import json
 import os
+import shutil
+import tempfile
+from unittest.mock import patch
 
-from django.db import connection
-from django.test import TestCase
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from model_bakery import baker
 
 import bouwdossiers.constants as const
+from bag.bag_controller import BagController
+from bag.models import Openbareruimte
+from bouwdossiers import models as bouwdossiers_models
 from importer import batch, models
 from importer.batch import log as logger
+from importer.tests.test_util_azure import create_blob_container, store_blob_in_container
+from importer.util_db import (
+    analyze_tables,
+    bulk_load,
+    copy_import_files_between_apps,
+    drop_secondary_indexes,
+    restore_bulk_loaded_tables,
+    set_tables_logged,
+    swap_tables_between_apps,
+    truncate_tables,
+)
+from importer.util_db import log as util_db_logger
 
 CURRENT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(CURRENT_DIRECTORY, "data")
@@ -18,6 +40,7 @@ class APITest(TestCase):
             bag_data = fbag.read()
         with connection.cursor() as cursor:
             cursor.execute(bag_data)
+        BagController.refresh_adres_lookup()
 
     def setUp(self):
         pass
@@ -240,6 +263,76 @@ class APITest(TestCase):
         self.assertEqual(adres1.huisnummer_van, 49)
         self.assertEqual(adres1.verblijfsobjecten, ["0363010000893549"])
 
+    def test_wabo_import_small_batches(self):
+        batch.import_wabo_dossiers(DATA_DIR, batch_size=2)
+
+        # Duplicate dossiernrs still get an 'X' added when they end up in different batches
+        self.assertEqual(
+            sorted(models.BouwDossier.objects.filter(stadsdeel="SDW").values_list("dossiernr", flat=True)),
+            ["2", "2X", "2XX"],
+        )
+        bd1 = models.BouwDossier.objects.get(dossiernr=189)
+        self.assertEqual(models.Adres.objects.filter(bouwdossier_id=bd1.id).count(), 25)
+        self.assertEqual(models.Document.objects.filter(bouwdossier_id=bd1.id).count(), 20)
+
+    def _imported_rows(self):
+        # All imported rows without the generated keys, to compare imports with each other
+        return [
+            sorted(
+                tuple(str(value) for value in row)
+                for row in model.objects.values_list(
+                    *[
+                        field.attname
+                        for field in model._meta.concrete_fields
+                        if not field.primary_key and not field.is_relation
+                    ]
+                )
+            )
+            for model in (models.BouwDossier, models.Adres, models.Document)
+        ]
+
+    def test_import_copy_writer(self):
+        batch.import_pre_wabo_dossiers(DATA_DIR, writer="copy")
+        batch.import_wabo_dossiers(DATA_DIR, writer="copy", batch_size=2)
+        copied_rows = self._imported_rows()
+
+        self.assertEqual(
+            sorted(models.BouwDossier.objects.filter(stadsdeel="SDW").values_list("dossiernr", flat=True)),
+            ["2", "2X", "2XX"],
+        )
+        bd1 = models.BouwDossier.objects.get(dossiernr=189)
+        self.assertEqual(models.Adres.objects.filter(bouwdossier_id=bd1.id).count(), 25)
+        self.assertEqual(models.Document.objects.filter(bouwdossier_id=bd1.id).count(), 20)
+
+        # The same files imported with bulk inserts give exactly the same rows
+        models.ImportFile.objects.all().delete()
+        batch.import_pre_wabo_dossiers(DATA_DIR, writer="orm")
+        batch.import_wabo_dossiers(DATA_DIR, writer="orm", batch_size=2)
+        self.assertEqual(self._imported_rows(), copied_rows)
+
+    def test_import_blob_source(self):
+        container_name = "dossiers-import"
+        create_blob_container(container_name)
+        for file_path in glob.glob(DATA_DIR + "/**/*.*", recursive=True):
+            if file_path.endswith((".xml", ".json")):
+                store_blob_in_container(container_name, file_path, os.path.relpath(file_path, DATA_DIR))
+
+        # The blobs are named like the local files, so both sources give the same import
+        source = batch.BlobSource(container_name, DATA_DIR)
+        batch.import_pre_wabo_dossiers(DATA_DIR, source=source)
+        batch.import_wabo_dossiers(DATA_DIR, source=source)
+        blob_import_files = sorted(models.ImportFile.objects.values_list("name", "status", "content_hash", "size"))
+        blob_rows = self._imported_rows()
+
+        models.ImportFile.objects.all().delete()
+        batch.import_pre_wabo_dossiers(DATA_DIR)
+        batch.import_wabo_dossiers(DATA_DIR)
+        self.assertEqual(
+            sorted(models.ImportFile.objects.values_list("name", "status", "content_hash", "size")), blob_import_files
+        )
+        self.assertEqual(self._imported_rows(), blob_rows)
+        self.assertEqual(batch.get_file_digest(blob_import_files[0][0]), blob_import_files[0][2:])
+
     def test_get_meta_additions_not_found(self):
         with self.assertLogs(logger, level="ERROR") as log:
             BWT_ids = batch._get_meta_additions("foutpad")
@@ -251,12 +344,252 @@ class APITest(TestCase):
 
     def test_get_meta_additions(self):
         BWT_ids = batch._get_meta_additions(DATA_DIR)
-        self.assertEqual(BWT_ids.get("SDW_2").get("dossier_access"), const.ACCESS_RESTRICTED)
+        self.assertIn("SDW_2", BWT_ids)
+        self.assertEqual(BWT_ids.get_dossier_access("SDW_2"), const.ACCESS_RESTRICTED)
+
+        _result = BWT_ids.get_adres("SDW_2", "bos en lommerplein_159")
+        self.assertEqual(_result.openbareruimte_id, "0363300000002992")
+        self.assertIsNone(BWT_ids.get_adres("SDW_2", "bos en lommerplein_0"))
+        self.assertIsNone(BWT_ids.get_adres("SDW_3", "bos en lommerplein_159"))
+
+    def test_meta_additions_index(self):
+        with open(f"{DATA_DIR}/META_ADDITIONS/META_ADDITIONS.json") as f:
+            meta_json = json.load(f)
+        BWT_ids = batch._get_meta_additions(DATA_DIR)
+
+        # Every address in the json file is found through the index, the first one wins on doubles
+        self.assertEqual(len(BWT_ids), len(meta_json))
+        for key, meta_dossier in meta_json.items():
+            for item in meta_dossier["adressen"]:
+                first_item = next(
+                    i for i in meta_dossier["adressen"] if i["straat_huisnummer"] == item["straat_huisnummer"]
+                )
+                _result = BWT_ids.get_adres(key, item["straat_huisnummer"])
+                self.assertEqual(list(_result.panden), first_item["panden"])
+                self.assertEqual(list(_result.verblijfsobjecten), first_item["verblijfsobjecten"])
+                self.assertEqual(_result.openbareruimte_id, first_item["openbareruimte_id"])
+                self.assertEqual(list(_result.nummeraanduidingen), first_item["nummeraanduidingen"])
+
+    def test_meta_additions_without_straat_huisnummer(self):
+        meta_json = {
+            "SDW_2": {
+                "dossier_access": const.ACCESS_PUBLIC,
+                "adressen": [
+                    {"panden": ["0363100012168986"]},
+                    {"straat_huisnummer": "bos en lommerplein_159", "panden": ["0363100012143649"]},
+                ],
+            }
+        }
+        BWT_ids = batch.MetaAdditions.load(io.StringIO(json.dumps(meta_json)))
+
+        self.assertEqual(BWT_ids.get_dossier_access("SDW_2"), const.ACCESS_PUBLIC)
+        self.assertEqual(BWT_ids.get_adres("SDW_2", "bos en lommerplein_159").panden, ("0363100012143649",))
+
+    def test_scan_dossier_files(self):
+        wabo_file_paths, pre_wabo_file_paths = batch.scan_dossier_files(DATA_DIR)
+        self.assertEqual(
+            sorted(os.path.relpath(file_path, DATA_DIR) for file_path in wabo_file_paths),
+            ["WABO/SDC BWT/datapunt BWT vergunningen_test.xml", "WABO/SDC/datapunt vergunningen_test.xml"],
+        )
+        self.assertEqual(
+            sorted(os.path.basename(file_path) for file_path in pre_wabo_file_paths),
+            ["SAA_BWT_Centrum_Test.xml", "SAA_BWT_Oost_test.xml"],
+        )
+
+        # Files that are already imported are left out, with one query for all of them
+        batch.import_pre_wabo_dossiers(DATA_DIR, file_paths=pre_wabo_file_paths)
+        with self.assertNumQueries(1):
+            self.assertEqual(batch.scan_dossier_files(DATA_DIR), (wabo_file_paths, []))
+
+    def test_copy_unchanged_files(self):
+        # Make an import of the pre-WABO and WABO files the previous import
+        batch.import_pre_wabo_dossiers(DATA_DIR)
+        batch.import_wabo_dossiers(DATA_DIR)
+        import_file_ids = list(models.ImportFile.objects.values_list("id", flat=True))
+        self.assertTrue(all(models.ImportFile.objects.values_list("content_hash", flat=True)))
+        copy_import_files_between_apps("importer", "bouwdossiers", import_file_ids)
+        truncate_tables(["importer"])
+        # The adressen were matched with the BAG of the previous import
+        bouwdossiers_models.Adres.objects.update(
+            panden=["0363100012345678"],
+            verblijfsobjecten=["0363010012345678"],
+            verblijfsobjecten_label=["Proefstraat 1"],
+            nummeraanduidingen=["0363200012345678"],
+            nummeraanduidingen_label=["Proefstraat 1"],
+            openbareruimte_id="0363300000000000",
+        )
+
+        changed_file = bouwdossiers_models.ImportFile.objects.get(name__endswith="SAA_BWT_Oost_test.xml")
+        changed_file.content_hash = "0" * 64
+        changed_file.save()
+
+        self.assertEqual(batch.copy_unchanged_files(DATA_DIR), 1)
+        self.assertEqual(
+            list(models.ImportFile.objects.values_list("name", flat=True)),
+            [os.path.join(DATA_DIR, "SAA_BWT_Centrum_Test.xml")],
+        )
+        unchanged_dossiers = bouwdossiers_models.BouwDossier.objects.filter(
+            importfile__name__endswith="SAA_BWT_Centrum_Test.xml"
+        )
+        self.assertEqual(
+            sorted(models.BouwDossier.objects.values_list("id", "dossiernr")),
+            sorted(unchanged_dossiers.values_list("id", "dossiernr")),
+        )
+        self.assertEqual(
+            models.Adres.objects.count(),
+            bouwdossiers_models.Adres.objects.filter(bouwdossier__in=unchanged_dossiers).count(),
+        )
+        # The copied adressen are matched again with the current BAG
+        self.assertEqual(
+            list(
+                models.Adres.objects.values_list(
+                    "panden",
+                    "verblijfsobjecten",
+                    "verblijfsobjecten_label",
+                    "nummeraanduidingen",
+                    "nummeraanduidingen_label",
+                    "openbareruimte_id",
+                ).distinct()
+            ),
+            [([], [], [], [], [], None)],
+        )
 
-        _adressen = BWT_ids.get("SDW_2").get("adressen")
-        self.assertIsInstance(_adressen, list)
-        _result = [item for item in _adressen if item.get("straat_huisnummer") == "bos en lommerplein_159"][0]
-        self.assertEqual(_result["openbareruimte_id"], "0363300000002992")
+        # Only the changed file and the WABO files are imported again, with new ids after the copied ones
+        wabo_file_paths, pre_wabo_file_paths = batch.scan_dossier_files(DATA_DIR)
+        self.assertEqual(pre_wabo_file_paths, [changed_file.name])
+        self.assertEqual(len(wabo_file_paths), 2)
+        batch.import_pre_wabo_dossiers(DATA_DIR, file_paths=pre_wabo_file_paths)
+        batch.import_wabo_dossiers(DATA_DIR, file_paths=wabo_file_paths)
+        self.assertEqual(models.BouwDossier.objects.count(), bouwdossiers_models.BouwDossier.objects.count())
+
+    def test_copy_unchanged_files_blob_source(self):
+        container_name = "dossiers-incremental"
+        create_blob_container(container_name)
+        for file_name in ["SAA_BWT_Centrum_Test.xml", "SAA_BWT_Oost_test.xml"]:
+            store_blob_in_container(container_name, f"{DATA_DIR}/{file_name}", file_name)
+        source = batch.BlobSource(container_name, DATA_DIR)
+
+        batch.import_pre_wabo_dossiers(DATA_DIR, source=source)
+        self.assertTrue(all(models.ImportFile.objects.values_list("etag", flat=True)))
+        copy_import_files_between_apps(
+            "importer", "bouwdossiers", models.ImportFile.objects.values_list("id", flat=True)
+        )
+        truncate_tables(["importer"])
+
+        changed_file = bouwdossiers_models.ImportFile.objects.get(name__endswith="SAA_BWT_Oost_test.xml")
+        changed_file.etag = '"changed"'
+        changed_file.save()
+
+        # The blobs are compared on their ETag, without downloading them
+        with patch.object(batch, "get_file_digest", side_effect=AssertionError("blob downloaded")):
+            self.assertEqual(batch.copy_unchanged_files(DATA_DIR, source), 1)
+        self.assertEqual(
+            list(models.ImportFile.objects.values_list("name", flat=True)),
+            [os.path.join(DATA_DIR, "SAA_BWT_Centrum_Test.xml")],
+        )
+
+    def test_reset_unfinished_files(self):
+        batch.import_pre_wabo_dossiers(DATA_DIR)
+        # Pretend the import of one of the files was interrupted
+        unfinished_file = models.ImportFile.objects.get(name__endswith="SAA_BWT_Oost_test.xml")
+        unfinished_file.status = const.IMPORT_BUSY
+        unfinished_file.save()
+        finished_count = models.BouwDossier.objects.exclude(importfile=unfinished_file).count()
+
+        self.assertEqual(batch.reset_unfinished_files(), 1)
+        self.assertFalse(models.ImportFile.objects.filter(status=const.IMPORT_BUSY).exists())
+        self.assertEqual(models.BouwDossier.objects.count(), finished_count)
+
+        # Only the unfinished file is imported again
+        _, pre_wabo_file_paths = batch.scan_dossier_files(DATA_DIR)
+        self.assertEqual(pre_wabo_file_paths, [unfinished_file.name])
+
+    def test_skipped_duplicates_are_not_counted(self):
+        # All dossiernrs of SDC_189 are taken, so that dossier is skipped
+        for dossiernr in ["189", "189X", "189XX"]:
+            baker.make(models.BouwDossier, stadsdeel="SDC", dossiernr=dossiernr)
+
+        count = batch.import_dossier_file(
+            f"{DATA_DIR}/WABO/SDC/datapunt vergunningen_test.xml",
+            batch.add_wabo_dossier,
+            batch._get_meta_additions(DATA_DIR),
+        )
+        self.assertEqual(count, 6)
+        self.assertEqual(models.BouwDossier.objects.filter(source=const.SOURCE_WABO).count(), 6)
+
+    def test_import_unfinished(self):
+        self.assertFalse(batch.is_import_unfinished())
+        batch.set_import_unfinished(True)
+        self.assertTrue(batch.is_import_unfinished())
+
+        # The mark is cleared before the swap, so the previous import in the importer tables
+        # is not taken for an unfinished one
+        batch.set_import_unfinished(False)
+        swap_tables_between_apps("importer", "bouwdossiers")
+        self.assertFalse(batch.is_import_unfinished())
+
+    def test_openbareruimte_preference(self):
+        baker.make(Openbareruimte, id="0363300000900001", naam="Proefstraat", typecode="2", einde_geldigheid=None)
+        baker.make(Openbareruimte, id="0363300000900002", naam="Proefstraat", typecode="1", einde_geldigheid=None)
+        baker.make(Openbareruimte, id="0363300000900003", naam="Proefkade", typecode="2", einde_geldigheid=None)
+        baker.make(Openbareruimte, id="0363300000900004", naam="Proefkade", typecode="1", einde_geldigheid="2000-01-01")
+
+        bouwdossier = baker.make(models.BouwDossier, importfile=baker.make(models.ImportFile))
+        adres_values = {"nummeraanduidingen": [], "nummeraanduidingen_label": [], "panden": [], "verblijfsobjecten": []}
+        adressen = {
+            name: models.Adres.objects.create(
+                bouwdossier=bouwdossier,
+                straat=straat,
+                openbareruimte_id=openbareruimte_id,
+                verblijfsobjecten_label=[],
+                **adres_values,
+            )
+            for name, straat, openbareruimte_id in (
+                ("preferred", "Proefstraat", "0363300000000000"),
+                ("fallback", "Proefkade", None),
+                ("fallback_empty", "Proefkade", ""),
+                ("kept", "Proefkade", "0363300000000000"),
+            )
+        }
+
+        batch.add_bag_ids_to_pre_wabo()
+
+        openbareruimte_ids = {
+            name: models.Adres.objects.get(id=adres.id).openbareruimte_id for name, adres in adressen.items()
+        }
+        self.assertEqual(
+            openbareruimte_ids,
+            {
+                # A valid street replaces the openbareruimte that was there
+                "preferred": "0363300000900002",
+                # Without a valid street only a missing openbareruimte is filled in
+                "fallback": "0363300000900003",
+                "fallback_empty": "0363300000900003",
+                "kept": "0363300000000000",
+            },
+        )
+
+    def test_analyze_tables(self):
+        batch.import_pre_wabo_dossiers(DATA_DIR)
+        analyze_tables("importer")
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT statistics_name FROM pg_stats_ext WHERE tablename = 'importer_adres'")
+            self.assertEqual(cursor.fetchall(), [("importer_adres_straat_huisnummer_stat",)])
+            cursor.execute("SELECT COUNT(*) FROM pg_stats WHERE tablename = 'importer_bouwdossier'")
+            self.assertGreater(cursor.fetchone()[0], 0)
+
+    def test_matching_query_plans_are_logged(self):
+        batch.import_pre_wabo_dossiers(DATA_DIR)
+        with self.assertLogs(util_db_logger, level="INFO") as log:
+            batch.add_bag_ids_to_pre_wabo()
+        self.assertEqual(
+            [line.split("\n")[0] for line in log.output if "Query plan" in line],
+            [
+                "INFO:importer.util_db:Query plan of the pre-WABO matching of adres ids "
+                f"{models.Adres.objects.order_by('id').first().id}-{models.Adres.objects.order_by('id').last().id}:",
+                "INFO:importer.util_db:Query plan of the openbare ruimte matching:",
+            ],
+        )
 
     def test_validate_import(self):
         batch.import_pre_wabo_dossiers(DATA_DIR)
@@ -264,3 +597,171 @@ class APITest(TestCase):
         batch.import_wabo_dossiers(DATA_DIR)
         batch.add_bag_ids_to_wabo()
         batch.validate_import(min_bouwdossiers_count=43)
+
+    def test_import_counters(self):
+        # Start from a copied file, like an incremental import
+        batch.import_pre_wabo_dossiers(DATA_DIR, file_paths=[os.path.join(DATA_DIR, "SAA_BWT_Centrum_Test.xml")])
+        counters = batch.ImportCounters.from_db()
+        self.assertEqual(counters["prewabo_total"], models.Adres.objects.count())
+
+        batch.import_pre_wabo_dossiers(DATA_DIR, counters=counters)
+        batch.add_bag_ids_to_pre_wabo(counters=counters)
+        batch.import_wabo_dossiers(DATA_DIR, counters=counters)
+        batch.add_bag_ids_to_wabo(counters=counters)
+
+        result = counters.as_result()
+        self.assertEqual(result, batch.ImportCounters.from_db().as_result())
+        self.assertGreater(result["prewabo_has_panden"], 0)
+        self.assertGreater(result["wabo_has_nummeraanduidingen"], 0)
+        self.assertGreater(result["has_openbareruimte_id"], 0)
+        with self.assertNumQueries(0):
+            batch.validate_import(min_bouwdossiers_count=43, counters=counters)
+
+
+class DossierKeysTest(SimpleTestCase):
+    def test_wabo_duplicates_get_suffix(self):
+        dossier_keys = batch.DossierKeys()
+        dossiernrs = []
+        for _ in range(3):
+            bouwdossier = models.BouwDossier(stadsdeel="SDW", dossiernr="2", source=const.SOURCE_WABO)
+            self.assertTrue(dossier_keys.claim(bouwdossier, "test.xml"))
+            dossiernrs.append(bouwdossier.dossiernr)
+        self.assertEqual(dossiernrs, ["2", "2X", "2XX"])
+
+    def test_wabo_duplicates_run_out(self):
+        dossier_keys = batch.DossierKeys([("SDW", "2"), ("SDW", "2X"), ("SDW", "2XX")])
+        bouwdossier = models.BouwDossier(stadsdeel="SDW", dossiernr="2", source=const.SOURCE_WABO)
+        with self.assertLogs(logger, level="ERROR"):
+            self.assertFalse(dossier_keys.claim(bouwdossier, "test.xml"))
+
+    def test_pre_wabo_duplicate_raises(self):
+        dossier_keys = batch.DossierKeys([("SA", "00003")])
+        bouwdossier = models.BouwDossier(stadsdeel="SA", dossiernr="00003", source=const.SOURCE_EDEPOT)
+        with self.assertRaises(IntegrityError):
+            dossier_keys.claim(bouwdossier, "test.xml")
+
+    def test_rollback_releases_pending_keys(self):
+        dossier_keys = batch.DossierKeys()
+        dossier_keys.claim(models.BouwDossier(stadsdeel="SDC", dossiernr="1", source=const.SOURCE_WABO), "a.xml")
+        dossier_keys.rollback()
+        self.assertNotIn(("SDC", "1"), dossier_keys)
+
+        dossier_keys.claim(models.BouwDossier(stadsdeel="SDC", dossiernr="1", source=const.SOURCE_WABO), "b.xml")
+        dossier_keys.commit()
+        self.assertIn(("SDC", "1"), dossier_keys)
+
+
+class ParallelImportTest(TransactionTestCase):
+    def test_wabo_import_parallel(self):
+        batch.import_wabo_dossiers(DATA_DIR, workers=2)
+
+        self.assertEqual(
+            models.ImportFile.objects.filter(status=const.IMPORT_FINISHED).count(),
+            2,
+        )
+        self.assertEqual(models.BouwDossier.objects.filter(source=const.SOURCE_WABO).count(), 11)
+        bd1 = models.BouwDossier.objects.get(dossiernr=189)
+        self.assertEqual(models.Adres.objects.filter(bouwdossier_id=bd1.id).count(), 25)
+        self.assertEqual(models.Document.objects.filter(bouwdossier_id=bd1.id).count(), 20)
+
+    def test_prewabo_matching_parallel(self):
+        with open(f"{DATA_DIR}/add_bag.sql") as fbag:
+            with connection.cursor() as cursor:
+                cursor.execute(fbag.read())
+        BagController.refresh_adres_lookup()
+
+        def matched_adressen():
+            return sorted(
+                models.Adres.objects.values_list(
+                    "bouwdossier__dossiernr",
+                    "straat",
+                    "huisnummer_van",
+                    "huisnummer_tot",
+                    "openbareruimte_id",
+                    "nummeraanduidingen",
+                    "nummeraanduidingen_label",
+                    "panden",
+                    "verblijfsobjecten",
+                    "verblijfsobjecten_label",
+                ),
+                key=str,
+            )
+
+        batch.import_pre_wabo_dossiers(DATA_DIR)
+        batch.add_bag_ids_to_pre_wabo()
+        expected = matched_adressen()
+        self.assertTrue(any(adres[5] for adres in expected))
+
+        truncate_tables(["importer"])
+        batch.import_pre_wabo_dossiers(DATA_DIR)
+        batch.add_bag_ids_to_pre_wabo(workers=3)
+        self.assertEqual(matched_adressen(), expected)
+
+    def test_bulk_load(self):
+        def table_state():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+SELECT c.relname, c.relpersistence, ARRAY(
+    SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i WHERE i.indrelid = c.oid ORDER BY 1
+)
+FROM pg_class c
+WHERE c.relname LIKE 'importer%%' AND c.relkind = 'r'
+ORDER BY c.relname
+                    """
+                )
+                return cursor.fetchall()
+
+        before = table_state()
+        with bulk_load("importer", workers=2):
+            during = table_state()
+            batch.import_pre_wabo_dossiers(DATA_DIR)
+            batch.import_wabo_dossiers(DATA_DIR)
+
+        self.assertEqual(table_state(), before)
+        self.assertTrue(all(persistence == "p" for _, persistence, _ in before))
+        self.assertTrue(all(persistence == "u" for _, persistence, _ in during))
+        indexes_before = {name: indexes for name, _, indexes in before}
+        indexes_during = {name: indexes for name, _, indexes in during}
+        self.assertFalse(any("USING gin" in index for index in indexes_during["importer_adres"]))
+        self.assertTrue(any("USING gin" in index for index in indexes_before["importer_adres"]))
+        self.assertTrue(any("UNIQUE" in index for index in indexes_during["importer_bouwdossier"]))
+        self.assertEqual(models.BouwDossier.objects.filter(source=const.SOURCE_WABO).count(), 11)
+
+        # A run that is killed during a bulk load leaves the tables behind like this, the next
+        # run restores them from the index definitions that are kept in the database
+        set_tables_logged("importer", False)
+        drop_secondary_indexes("importer")
+        self.assertNotEqual(table_state(), before)
+        restore_bulk_loaded_tables("importer", workers=2)
+        self.assertEqual(table_state(), before)
+
+    def test_duplicate_dossiers_parallel(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            # Both files hold the same dossiers, so the dossiers of one of them get an 'X'
+            os.makedirs(f"{root_dir}/WABO/SDC")
+            for name in ["a.xml", "b.xml"]:
+                shutil.copy(f"{DATA_DIR}/WABO/SDC/datapunt vergunningen_test.xml", f"{root_dir}/WABO/SDC/{name}")
+
+            def imported_dossiers():
+                return sorted(
+                    (os.path.basename(name), dossiernr)
+                    for name, dossiernr in models.BouwDossier.objects.values_list("importfile__name", "dossiernr")
+                )
+
+            batch.import_wabo_dossiers(root_dir)
+            expected = imported_dossiers()
+            self.assertTrue(all(not dossiernr.endswith("X") for name, dossiernr in expected if name == "a.xml"))
+            self.assertTrue(all(dossiernr.endswith("X") for name, dossiernr in expected if name == "b.xml"))
+
+            truncate_tables(["importer"])
+            counters = batch.ImportCounters()
+            batch.import_wabo_dossiers(root_dir, workers=2, counters=counters)
+            self.assertEqual(imported_dossiers(), expected)
+            # The adressen of the file that was imported again are counted once
+            self.assertEqual(counters.as_result(), batch.ImportCounters.from_db().as_result())
+
+    def test_import_counters_parallel(self):
+        counters = batch.ImportCounters()
+        batch.import_wabo_dossiers(DATA_DIR, workers=2, counters=counters)
+        self.assertEqual(counters.as_result(), batch.ImportCounters.from_db().as_result())
@@ -1,5 +1,6 @@
 import logging
 import os
+import tempfile
 from pathlib import Path
 
 from azure.core.exceptions import ResourceExistsError
@@ -10,6 +11,7 @@ from importer.util_azure import (
     get_blob_client,
     get_blob_container_client,
     get_container_client,
+    sync_container_to_directory,
 )
 
 log = logging.getLogger(__name__)
@@ -63,3 +65,35 @@ class APITest(TestCase):
                 ]
             )
         )
+
+    def test_sync_container_to_directory(self):
+        container_name = "dossiers-sync"
+        create_blob_container(container_name)
+        wabo_blob_name = "WABO/SDC/datapunt vergunningen_test.xml"
+        pre_wabo_blob_name = "SAA_BWT_Centrum_Test.xml"
+        store_blob_in_container(container_name, Path(DATA_DIR, wabo_blob_name), wabo_blob_name)
+        store_blob_in_container(container_name, Path(DATA_DIR, pre_wabo_blob_name), pre_wabo_blob_name)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            files = sync_container_to_directory(container_name, output_dir, workers=2)
+            self.assertEqual(
+                sorted(files), sorted(os.path.join(output_dir, name) for name in [wabo_blob_name, pre_wabo_blob_name])
+            )
+
+            # Nothing changed, so nothing is downloaded
+            self.assertEqual(sync_container_to_directory(container_name, output_dir, workers=2), [])
+
+            # A changed blob is downloaded again and a removed blob is deleted locally
+            store_blob_in_container(container_name, Path(DATA_DIR, "SAA_BWT_Oost_test.xml"), pre_wabo_blob_name)
+            get_blob_client(container_name, wabo_blob_name).delete_blob()
+            Path(output_dir, "unknown.xml").write_text("<unknown/>")
+
+            files = sync_container_to_directory(container_name, output_dir, workers=2)
+            self.assertEqual(files, [os.path.join(output_dir, pre_wabo_blob_name)])
+            self.assertEqual(
+                Path(output_dir, pre_wabo_blob_name).read_bytes(),
+                Path(DATA_DIR, "SAA_BWT_Oost_test.xml").read_bytes(),
+            )
+            self.assertFalse(Path(output_dir, wabo_blob_name).exists())
+            self.assertFalse(Path(output_dir, "WABO").exists())
+            self.assertFalse(Path(output_dir, "unknown.xml").exists())
@@ -0,0 +1,95 @@
+import glob
+import os
+import re
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from importer.util_bestand import normalize_bestand_url
+
+CURRENT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(CURRENT_DIRECTORY, "data")
+
+URLS = [
+    "https://conversiestraatwabo.amsterdam.nl/webDAV/SDC/SquitXO/12345/folder/file.pdf",
+    "https://conversiestraatwabo.amsterdam.nl/webDAV/SDC/KEY2/12345/folder/file.pdf",
+    "https://conversiestraatwabo.amsterdam.nl/webDAV/SDC/Decos/12345/folder/file.pdf",
+    "https://conversiestraatwabo.amsterdam.nl/webDAV/SDW/KEY2/2/file.pdf",
+    "https://bwt.hs3-saa-bwt.shcp04.archivingondemand.nl/SDC BWT/1/SA00279184_00001.jpg",
+    "J:/INZAGEDOCS/Datapunt/SDC BWT/1/SA00279184_00001.jpg",
+    "J:/INZAGEDOCS/Datapunt/SDC/Decos/BWT/file.jpg",
+    "SDC/SquitXO/file.pdf",
+    "KEY2/file.pdf",
+    "https://example.com/SDC/KEY2/12345/folder/file.pdf",
+    "https://conversiestraatwabo.amsterdam.nl/webDAV/SDC_NONWABO/ACTIVITY_DOCS/Procesinformatie_sdc_prewabo_412_0_v.pdf",
+    "https://conversiestraatwabo.amsterdam.nl/webDAV/SDC_NONWABO/DOCUMENTUM/PRIMARY/1/0901B69980298975.PDF",
+    "",
+]
+
+
+def reference_normalize_bestand_url(bestand_str, stadsdeel):
+    # The url rewrite as it was done in add_wabo_dossier before it got its own module
+    for base_url in settings.WABO_BASE_URL:
+        bestand_str = bestand_str.replace(base_url, "")
+
+    b = re.search(r"(SquitXO|KEY2|Decos|BWT)", bestand_str)
+    if b:
+        b_type = b.group(1)
+        mapping = {
+            "KEY2": "Key2",
+            "SquitXO": "SquitXO",
+            "Decos": "Decos",
+            "BWT": "Decos",
+        }
+        bestand_type = mapping[b_type]
+
+        _parts = bestand_str.split("/")
+
+        if "BWT" in _parts[0]:
+            _parts[0] = _parts[0].replace(" ", "/")
+            bestand_str = "/".join(_parts)
+        else:
+            _parts.pop(-2)
+            bestand_str = "/".join(_parts)
+            bestand_str = re.sub(
+                rf"^{stadsdeel}/",
+                f"{stadsdeel}/{bestand_type}/",
+                bestand_str,
+            )
+    return bestand_str
+
+
+def data_urls():
+    urls = []
+    for file_path in glob.iglob(DATA_DIR + "/**/*.xml", recursive=True):
+        with open(file_path) as f:
+            urls.extend(re.findall(r"<URL>([^<]*)</URL>", f.read()))
+    return urls
+
+
+class NormalizeBestandUrlTest(SimpleTestCase):
+    def test_same_result_as_reference(self):
+        for url in URLS + data_urls():
+            for stadsdeel in ("SDC", "SDW"):
+                with self.subTest(url=url, stadsdeel=stadsdeel):
+                    self.assertEqual(
+                        normalize_bestand_url(url, stadsdeel), reference_normalize_bestand_url(url, stadsdeel)
+                    )
+
+    def test_normalize_bestand_url(self):
+        self.assertEqual(
+            normalize_bestand_url(
+                "https://conversiestraatwabo.amsterdam.nl/webDAV/SDC/KEY2/12345/folder/file.pdf", "SDC"
+            ),
+            "SDC/Key2/KEY2/12345/file.pdf",
+        )
+        self.assertEqual(
+            normalize_bestand_url("J:/INZAGEDOCS/Datapunt/SDC BWT/1/SA00279184_00001.jpg", "SDC"),
+            "SDC/BWT/1/SA00279184_00001.jpg",
+        )
+
+    def test_url_without_type_only_loses_base_url(self):
+        self.assertEqual(
+            normalize_bestand_url("https://conversiestraatwabo.amsterdam.nl/webDAV/SDC/12345/file.pdf", "SDC"),
+            "SDC/12345/file.pdf",
+        )
@@ -0,0 +1,46 @@
+import io
+import os
+
+import xmltodict
+from django.test import SimpleTestCase
+
+from importer.util_xml import iter_xml_items
+
+CURRENT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(CURRENT_DIRECTORY, "data")
+
+
+class IterXmlItemsTest(SimpleTestCase):
+    def test_same_result_as_xmltodict(self):
+        file_path = f"{DATA_DIR}/WABO/SDC/datapunt vergunningen_test.xml"
+        with open(file_path) as fd:
+            expected = xmltodict.parse(fd.read())["dossiers"]["dossier"]
+
+        self.assertEqual(list(iter_xml_items(file_path, "dossier")), expected)
+
+    def test_only_direct_children_of_root(self):
+        xml = b"<dossiers><dossier><nr>1</nr><dossier>nested</dossier></dossier><other/><dossier><nr>2</nr></dossier></dossiers>"
+        items = list(iter_xml_items(io.BytesIO(xml), "dossier"))
+
+        self.assertEqual(items, [{"nr": "1", "dossier": "nested"}, {"nr": "2"}])
+
+    def test_single_item_is_not_a_list(self):
+        items = list(iter_xml_items(f"{DATA_DIR}/SAA_BWT_Oost_test.xml", "dossier"))
+
+        self.assertEqual(len(items), 1)
+        self.assertIsInstance(items[0], dict)
+
+    def test_default_namespace(self):
+        file_path = f"{DATA_DIR}/WABO/SDC/datapunt vergunningen_test.xml"
+        with open(file_path) as fd:
+            xml = fd.read().replace(
+                "<dossiers>",
+                '<dossiers xmlns="http://example.com/dossiers" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">',
+                1,
+            )
+        expected = xmltodict.parse(xml)["dossiers"]["dossier"]
+
+        items = list(iter_xml_items(io.BytesIO(xml.encode()), "dossier"))
+
+        self.assertEqual(len(items), 7)
+        self.assertEqual(items, expected)
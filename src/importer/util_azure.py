@@ -1,13 +1,19 @@
+import io
+import json
 import logging
 import os
-import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 from django.conf import settings
 
 log = logging.getLogger(__name__)
 
+# Keeps the ETag, size and last modified time of the blobs that were downloaded to a directory
+BLOB_MANIFEST_FILE = ".blob_manifest.json"
+
 
 def get_container_client():
     if settings.AZURITE_STORAGE_CONNECTION_STRING:
@@ -38,27 +44,162 @@ def download_blob_to_file(container_name, blob_name, output_dir):
     blob_client = get_blob_client(container_name=container_name, blob_name=blob_name)
     file_path = f"{output_dir}/{blob_name}"
     with open(file_path, "wb") as file:
-        blob = blob_client.download_blob().readall()
-        file.write(blob)
+        blob_client.download_blob().readinto(file)
     return file_path
 
 
-def download_all_files_from_container(container_name, output_dir=settings.DATA_DIR):
-    log.info(f"Downloading files from {container_name}")
+def _download_blob(container_client, blob_name, file_path):
+    # The blob is written to the file chunk by chunk, so it is never completely in memory. It goes
+    # to a temporary file first, so an interrupted download never leaves a partial file behind.
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    part_path = f"{file_path}.part"
+    with open(part_path, "wb") as file:
+        downloader = container_client.download_blob(blob_name)
+        downloader.readinto(file)
+    os.replace(part_path, file_path)
+    return _blob_manifest_entry(downloader.properties)
+
+
+def _iter_downloaded_blobs(container_client, container_name, blob_names, output_dir, workers):
+    """
+    Download blob_names on `workers` threads and yield (blob_name, manifest entry) for every
+    blob as soon as its download finished.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_download_blob, container_client, blob_name, os.path.join(output_dir, blob_name)): blob_name
+            for blob_name in blob_names
+        }
+        try:
+            for done_count, future in enumerate(as_completed(futures), 1):
+                yield futures[future], future.result()
+                if done_count % 100 == 0:
+                    log.info(f"Downloaded {done_count} of {len(blob_names)} files from {container_name}")
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _blob_manifest_entry(blob_properties):
+    return {
+        "etag": blob_properties.etag,
+        "size": blob_properties.size,
+        "last_modified": blob_properties.last_modified.isoformat(),
+    }
+
+
+def _read_blob_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as file:
+            return json.load(file)
+    except ValueError:
+        log.warning(f"Ignoring unreadable blob manifest {manifest_path}, all files will be downloaded")
+        return {}
+
+
+def _write_blob_manifest(manifest_path, manifest):
+    part_path = f"{manifest_path}.part"
+    with open(part_path, "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(part_path, manifest_path)
+
+
+def _remove_local_files(output_dir, blob_names):
+    """
+    Remove the files in output_dir that are not a blob (anymore), and the directories that are
+    empty after that. Returns the number of removed files.
+    """
+    removed_count = 0
+    for dir_path, _, file_names in os.walk(output_dir, topdown=False):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            relative_path = os.path.relpath(file_path, output_dir)
+            if relative_path != BLOB_MANIFEST_FILE and relative_path not in blob_names:
+                os.remove(file_path)
+                removed_count += 1
+        if dir_path != output_dir and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+    return removed_count
+
+
+def sync_container_to_directory(container_name, output_dir=settings.DATA_DIR, workers=settings.AZURE_DOWNLOAD_WORKERS):
+    """
+    Make output_dir a copy of the container while only downloading the blobs that are new or
+    changed since the previous sync. The ETag, size and last modified time of the downloaded
+    blobs are kept in a manifest in output_dir. Local files of blobs that were removed from
+    the container are deleted. Returns the paths of the downloaded files.
+    """
+    log.info(f"Synchronizing {output_dir} with {container_name} using {workers} workers")
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, BLOB_MANIFEST_FILE)
+    manifest = _read_blob_manifest(manifest_path)
     container_client = get_blob_container_client(container_name)
-    blob_list = container_client.list_blobs()
-
-    files = []
-    for blob in blob_list:
-        file_path = os.path.join(output_dir, blob.name)
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-
-        with open(file_path, "wb") as file:
-            file.write(container_client.download_blob(blob.name).readall())
-            files.append(file_path)
-    return files
-
 
-def remove_directory(dir):
-    if os.path.exists(dir):
-        shutil.rmtree(dir)
+    blobs = {blob.name: _blob_manifest_entry(blob) for blob in container_client.list_blobs()}
+    removed_count = _remove_local_files(output_dir, blobs.keys())
+
+    changed_blob_names = []
+    new_manifest = {}
+    for blob_name, entry in blobs.items():
+        file_path = os.path.join(output_dir, blob_name)
+        # A local file that went missing or was changed is downloaded again
+        if (
+            manifest.get(blob_name) == entry
+            and os.path.isfile(file_path)
+            and os.path.getsize(file_path) == entry["size"]
+        ):
+            new_manifest[blob_name] = entry
+        else:
+            changed_blob_names.append(blob_name)
+
+    # The manifest is also written when a download failed, so the blobs that were downloaded
+    # before the failure are not downloaded again next time
+    try:
+        for blob_name, entry in _iter_downloaded_blobs(
+            container_client, container_name, changed_blob_names, output_dir, workers
+        ):
+            new_manifest[blob_name] = entry
+    finally:
+        _write_blob_manifest(manifest_path, new_manifest)
+
+    log.info(
+        f"Downloaded {len(changed_blob_names)} new or changed files from {container_name}, "
+        f"{len(blobs) - len(changed_blob_names)} files were unchanged and {removed_count} files were removed"
+    )
+    return [os.path.join(output_dir, blob_name) for blob_name in changed_blob_names]
+
+
+class BlobReader(io.RawIOBase):
+    """
+    Read-only binary file object over a blob download. The blob is fetched chunk by chunk
+    while it is read, so only the current chunk is in memory.
+    """
+
+    def __init__(self, downloader):
+        self._chunks = downloader.chunks()
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def open_blob(container_client, blob_name):
+    try:
+        downloader = container_client.download_blob(blob_name)
+    except ResourceNotFoundError as e:
+        raise FileNotFoundError(f"Blob {blob_name} not found") from e
+    return io.BufferedReader(BlobReader(downloader))
@@ -0,0 +1,45 @@
+import re
+
+from django.conf import settings
+
+# Any of the base urls, these are removed to get urls relative to the dossier root like the pre-WABO urls
+BASE_URL_RE = re.compile("|".join(re.escape(base_url) for base_url in settings.WABO_BASE_URL))
+
+# The dossier type is taken from the first of these that occurs in the url
+BESTAND_TYPE_RE = re.compile(r"SquitXO|KEY2|Decos|BWT")
+BESTAND_TYPES = {
+    "KEY2": "Key2",
+    "SquitXO": "SquitXO",
+    "Decos": "Decos",
+    "BWT": "Decos",
+}
+
+
+def normalize_bestand_url(url, stadsdeel):
+    """
+    Turn the URL of a WABO bestand into the relative url of the bestand, as it is used for
+    pre-WABO bestanden as well. The base url is removed and the url is rewritten to
+    <stadsdeel>/<type>/<path without the folder of the file>. Urls of BWT files only get
+    the space in their first part replaced by a '/'.
+    """
+    url = BASE_URL_RE.sub("", url)
+
+    match = BESTAND_TYPE_RE.search(url)
+    if not match:
+        return url
+
+    first_part, separator, rest = url.partition("/")
+    if "BWT" in first_part:  # then it's from WABO/BWT and different url-format
+        return first_part.replace(" ", "/") + separator + rest
+
+    # Place the file directly under the dossier by removing the folder before the filename
+    head, separator, filename = url.rpartition("/")
+    if not separator:
+        return url
+    head, separator, _ = head.rpartition("/")
+    url = head + separator + filename
+
+    # Add the dossier type after the stadsdeel
+    if url.startswith(stadsdeel + "/"):
+        url = f"{stadsdeel}/{BESTAND_TYPES[match.group()]}/{url[len(stadsdeel) + 1 :]}"
+    return url
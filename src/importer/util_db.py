@@ -1,6 +1,19 @@
+import io
+import json
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 from django.apps import apps
 from django.db import connection, transaction
 
+log = logging.getLogger(__name__)
+
+# Characters that have to be escaped in the text format of COPY
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
 
 def get_app_model_names(model_name):
     app_models = apps.get_app_config(model_name).get_models()
@@ -36,3 +49,246 @@ ALTER TABLE {temp_model_name} RENAME TO {model};"""
 
     with connection.cursor() as cursor:
         cursor.execute(query)
+
+
+def analyze_tables(app):
+    """
+    Update the planner statistics of the tables of app, including their extended statistics.
+    Freshly loaded tables have no statistics until autovacuum gets to them.
+    """
+    started = time.perf_counter()
+    with connection.cursor() as cursor:
+        for table in get_app_model_names(app):
+            cursor.execute(f"ANALYZE {table}")
+    log.info(f"Analyzed the tables of {app} in {time.perf_counter() - started:.1f}s")
+
+
+def log_query_plan(cursor, description, query, params=None):
+    """
+    Log the plan the database picks for a query, so a changed plan can be found in the logs
+    """
+    cursor.execute(f"EXPLAIN {query}", params)
+    plan = "\n".join(line for (line,) in cursor.fetchall())
+    log.info(f"Query plan of {description}:\n{plan}")
+
+
+def get_table_state(table):
+    """
+    The state an import keeps in the comment of a table, as a dict. The comment is part of the
+    database, so the state is still there when the process was killed, and it goes along with
+    the table when the tables are swapped.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT obj_description(%s::regclass, 'pg_class')", [table])
+        comment = cursor.fetchone()[0]
+    try:
+        return json.loads(comment) if comment else {}
+    except ValueError:
+        log.warning(f"Ignoring the comment on {table}, it is not an import state: {comment}")
+        return {}
+
+
+def update_table_state(table, **changes):
+    """Update the state in the comment of a table, keys that are set to None are removed"""
+    state = {key: value for key, value in {**get_table_state(table), **changes}.items() if value is not None}
+    with connection.cursor() as cursor:
+        comment = cursor.mogrify("%s", [json.dumps(state)]).decode() if state else "NULL"
+        cursor.execute(f"COMMENT ON TABLE {table} IS {comment}")
+
+
+def set_tables_logged(app, logged):
+    """
+    Make the tables of app LOGGED or UNLOGGED. A logged table can not reference an unlogged
+    table, so the referenced tables are made unlogged last and logged first.
+    """
+    tables = get_app_model_names(app)
+    if not logged:
+        tables.reverse()
+    with connection.cursor() as cursor:
+        for table in tables:
+            cursor.execute(f"ALTER TABLE {table} SET {'LOGGED' if logged else 'UNLOGGED'}")
+
+
+def drop_secondary_indexes(app):
+    """
+    Drop the indexes of the tables of app that are not needed while loading them and return
+    their definitions. The primary keys, the unique constraints and the indexes on foreign
+    key columns are kept, duplicate dossiers and cascading deletes still depend on them.
+    The definitions are kept in the state of their table before the indexes are dropped, so
+    restore_bulk_loaded_tables can create them again after a run that was killed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+SELECT i.indrelid::regclass::text, i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid)
+FROM pg_index i
+WHERE i.indrelid = ANY(%s::regclass[])
+AND NOT i.indisunique
+AND NOT EXISTS (
+    SELECT FROM pg_constraint c
+    WHERE c.contype = 'f' AND c.conrelid = i.indrelid AND c.conkey = i.indkey::int2[]
+)
+ORDER BY 1
+            """,
+            [get_app_model_names(app)],
+        )
+        indexes = cursor.fetchall()
+
+        for table in {table for table, _, _ in indexes}:
+            dropped_indexes = get_table_state(table).get("dropped_indexes", [])
+            dropped_indexes += [definition for index_table, _, definition in indexes if index_table == table]
+            update_table_state(table, dropped_indexes=dropped_indexes)
+        for _, index_name, _ in indexes:
+            cursor.execute(f"DROP INDEX {index_name}")
+    return [definition for _, _, definition in indexes]
+
+
+def _create_index(definition):
+    # Every thread gets its own database connection, which is closed when the thread is done
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(definition)
+    finally:
+        connection.close()
+
+
+def create_indexes(definitions, workers=1):
+    """
+    Create indexes from their definitions, `workers` at the same time. Building indexes of
+    the same table at the same time is fine, CREATE INDEX only blocks writes to the table.
+    """
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(_create_index, definitions):
+                pass
+    else:
+        with connection.cursor() as cursor:
+            for definition in definitions:
+                cursor.execute(definition)
+
+
+def restore_bulk_loaded_tables(app, workers=1):
+    """
+    Create the indexes that were dropped for a bulk load of the tables of app, `workers` at
+    the same time, and make the tables LOGGED again. This also finishes a bulk load of a run
+    that was killed. Raises an exception when a table is still not restored afterwards, such
+    tables must not be swapped into use.
+    """
+    tables = get_app_model_names(app)
+    definitions = [
+        # Some of the indexes can be there already when restoring was interrupted
+        re.sub(r"^CREATE (UNIQUE )?INDEX ", r"CREATE \1INDEX IF NOT EXISTS ", definition)
+        for table in tables
+        for definition in get_table_state(table).get("dropped_indexes", [])
+    ]
+    if definitions:
+        log.info(f"Restoring the tables of {app}, creating {len(definitions)} indexes using {workers} workers")
+        create_indexes(definitions, workers)
+        for table in tables:
+            update_table_state(table, dropped_indexes=None)
+    set_tables_logged(app, True)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relname FROM pg_class WHERE oid = ANY(%s::regclass[]) AND relpersistence = 'u'", [tables]
+        )
+        unlogged_tables = [table for (table,) in cursor.fetchall()]
+    incomplete_tables = [table for table in tables if get_table_state(table).get("dropped_indexes")]
+    if unlogged_tables or incomplete_tables:
+        raise Exception(
+            f"The tables of {app} are not restored after a bulk load, unlogged: {unlogged_tables}, "
+            f"missing indexes: {incomplete_tables}"
+        )
+
+
+@contextmanager
+def bulk_load(app, workers=1):
+    """
+    Prepare the tables of app for loading a lot of rows: they are made UNLOGGED and their
+    secondary indexes are dropped. Afterwards the indexes are built again, `workers` at the
+    same time, and the tables are made LOGGED again, also when the load failed.
+    """
+    set_tables_logged(app, False)
+    definitions = drop_secondary_indexes(app)
+    log.info(f"Bulk load of {app}: tables are unlogged and {len(definitions)} indexes are dropped")
+    try:
+        yield
+    finally:
+        restore_bulk_loaded_tables(app, workers)
+
+
+@transaction.atomic
+def copy_import_files_between_apps(app1, app2, importfile_ids):
+    """
+    Copy import files with their bouwdossiers, adressen and documenten from the tables of
+    app1 to the tables of app2. The ids are kept, after which the id sequences of app2 are
+    moved past the copied ids.
+    """
+    tables = {model_name: f"{app2}_{model_name}" for model_name in ("importfile", "bouwdossier", "adres", "document")}
+    filters = {
+        "importfile": "id = ANY(%(ids)s)",
+        "bouwdossier": "importfile_id = ANY(%(ids)s)",
+        "adres": f"bouwdossier_id IN (SELECT id FROM {app1}_bouwdossier WHERE importfile_id = ANY(%(ids)s))",
+        "document": f"bouwdossier_id IN (SELECT id FROM {app1}_bouwdossier WHERE importfile_id = ANY(%(ids)s))",
+    }
+
+    with connection.cursor() as cursor:
+        for model_name, table in tables.items():
+            model = apps.get_model(app2, model_name)
+            columns = ", ".join(
+                connection.ops.quote_name(field.column) for field in model._meta.concrete_fields if not field.generated
+            )
+            cursor.execute(
+                f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {app1}_{model_name} WHERE {filters[model_name]}",
+                {"ids": list(importfile_ids)},
+            )
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) "
+                f"FROM {table}"
+            )
+
+
+def _array_literal(values):
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append("NULL")
+        else:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+            elements.append(f'"{value}"')
+    return "{" + ",".join(elements) + "}"
+
+
+def copy_value(value):
+    """The text format of COPY of a value"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, (list, tuple)):
+        value = _array_literal(value)
+    elif isinstance(value, bool):
+        value = "t" if value else "f"
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_model_instances(cursor, model, objs):
+    """
+    Insert model instances with COPY FROM STDIN. Values are prepared by the model fields
+    the same way the ORM would for an INSERT. The primary key column is only copied when
+    the instances already have one, otherwise the database default (the id sequence) is used.
+    """
+    if not objs:
+        return
+
+    fields = [
+        field
+        for field in model._meta.concrete_fields
+        if not field.generated and (not field.primary_key or objs[0].pk is not None)
+    ]
+    buffer = io.StringIO()
+    for obj in objs:
+        values = [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields]
+        buffer.write("\t".join(copy_value(value) for value in values) + "\n")
+    buffer.seek(0)
+
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    cursor.copy_expert(f"COPY {model._meta.db_table} ({columns}) FROM STDIN", buffer)
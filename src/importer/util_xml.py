@@ -0,0 +1,53 @@
+from xml.etree import ElementTree
+
+import xmltodict
+
+
+def iter_xml_items(source, item_tag):
+    """
+    Yield the `item_tag` children of the root element of an xml file one at a time, each
+    converted to the same dict structure xmltodict would give for it.
+
+    `source` can be a file name or a binary file object. Every item is released as soon as
+    it has been handed out, so memory use is bounded by the largest item instead of the
+    size of the whole file.
+
+    The items are matched on their local name, so a file with a default namespace gives the
+    same items as one without. Names keep the prefix they have in the file, as in xmltodict.
+    """
+    prefixes = {}
+    root = None
+    depth = 0
+    for event, element in ElementTree.iterparse(source, events=("start-ns", "start", "end")):
+        if event == "start-ns":
+            prefix, uri = element
+            prefixes.setdefault(uri, prefix)
+            continue
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1 and _local_name(element.tag) == item_tag:
+            for child in element.iter():
+                child.tag = _prefixed_name(child.tag, prefixes)
+                child.attrib = {_prefixed_name(name, prefixes): value for name, value in child.attrib.items()}
+            yield xmltodict.parse(ElementTree.tostring(element))[element.tag]
+            # Drop the processed items, the root element would otherwise keep the whole tree
+            root.clear()
+
+
+def _local_name(name):
+    """The name without the {namespace} ElementTree puts in front of it"""
+    return name.rpartition("}")[2]
+
+
+def _prefixed_name(name, prefixes):
+    """The name as it is written in the file, with the prefix of its namespace if it has one"""
+    if not name.startswith("{"):
+        return name
+    uri, _, local_name = name[1:].partition("}")
+    prefix = prefixes.get(uri)
+    return f"{prefix}:{local_name}" if prefix else local_name
@@ -23,6 +23,10 @@ class OTelJSONFormatter(logging.Formatter):
                 log_data["trace_id"] = format(ctx.trace_id, "032x")
                 log_data["span_id"] = format(ctx.span_id, "016x")
 
+        # Structured numbers passed with extra={"metrics": {...}}
+        if metrics := getattr(record, "metrics", None):
+            log_data["metrics"] = metrics
+
         if record.exc_info:
             log_data["exception"] = self.formatException(record.exc_info)
 
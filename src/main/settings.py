@@ -331,10 +331,30 @@ AZURITE_STORAGE_CONNECTION_STRING = os.getenv("AZURITE_STORAGE_CONNECTION_STRING
 
 AZURE_CONTAINER_NAME_BAG = "bag"
 AZURE_CONTAINER_NAME_DOSSIERS = "dossiers"
+# Number of blobs that are downloaded at the same time
+AZURE_DOWNLOAD_WORKERS = int(os.getenv("AZURE_DOWNLOAD_WORKERS", 8))
 
 MIN_BOUWDOSSIERS_COUNT = os.getenv("MIN_BOUWDOSSIERS_COUNT", 10000)
+# Number of worker processes used to import the dossier xml files
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", 1))
+# Number of bouwdossiers that are written to the database together
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+# How the dossiers are written to the database: "orm" (bulk inserts) or "copy" (COPY FROM STDIN)
+IMPORT_WRITER = os.getenv("IMPORT_WRITER", "orm")
+# Number of database connections used to match the pre-WABO adressen with the BAG
+IMPORT_MATCH_WORKERS = int(os.getenv("IMPORT_MATCH_WORKERS", 1))
+# Read the dossier files from disk after downloading them (files) or straight from the blob storage (blob)
+IMPORT_SOURCE = os.getenv("IMPORT_SOURCE", "files")
+# Load the importer tables unlogged and without their secondary indexes, which are built afterwards
+IMPORT_BULK_LOAD = os.getenv("IMPORT_BULK_LOAD", "false").lower() == "true"
 
 BAG_DUMP_BASE_URL = os.getenv("BAG_DUMP_BASE_URL", "https://api.data.amsterdam.nl/bulk-data/csv")
+# The BAG dumps are kept here between imports, so dumps that did not change are not downloaded again
+BAG_DUMP_DIR = os.getenv("BAG_DUMP_DIR", "/tmp")
+# Number of BAG dumps that are downloaded at the same time, while the first ones are imported
+BAG_DOWNLOAD_WORKERS = int(os.getenv("BAG_DOWNLOAD_WORKERS", 4))
+# How the BAG records are upserted: "orm" (bulk_create per 1000) or "copy" (COPY into a staging table)
+BAG_WRITER = os.getenv("BAG_WRITER", "orm")
 
 CONTENT_SECURITY_POLICY = {
     "DIRECTIVES": {